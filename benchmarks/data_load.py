@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# SCP-079-AVATAR - Get newly joined member's profile photo
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-AVATAR.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compare loading data files one by one and in a thread pool, with the files in the page cache and evicted from it
+# Usage: python3 -m benchmarks.data_load [users] [word maps]
+
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from os import O_RDONLY, close, listdir, open as os_open
+from os.path import getsize
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from plugins.storage import read_snapshot, write_snapshot
+from plugins.structures import UserStatus
+
+try:
+    from os import POSIX_FADV_DONTNEED, posix_fadvise
+except ImportError:
+    posix_fadvise = None
+
+
+def evict(path_list: list) -> bool:
+    # Drop the files from the page cache, so the next read comes from the disk
+    if posix_fadvise is None:
+        return False
+
+    for path in path_list:
+        fd = os_open(path, O_RDONLY)
+        posix_fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+        close(fd)
+
+    return True
+
+
+def load_pool(path_list: list) -> list:
+    # Load the files in a thread pool, as the loader did before
+    with ThreadPoolExecutor() as executor:
+        return list(executor.map(read_snapshot, path_list))
+
+
+def load_sequential(path_list: list) -> list:
+    # Load the files one by one, as glovar does
+    return [read_snapshot(path) for path in path_list]
+
+
+def write_files(path: str, user_count: int, word_count: int) -> list:
+    # Write user shards and word maps like the ones in data/
+    for shard in range(16):
+        users = {}
+
+        for uid in range(shard, user_count, 16):
+            users[uid] = UserStatus()
+            users[uid].set_join(-1001, uid)
+            users[uid].add_message(-1001, uid)
+
+        write_snapshot(f"{path}/user_ids.{shard}", users)
+
+    for i in range(word_count):
+        write_snapshot(f"{path}/words.{i}", {f"word{j}": j for j in range(20000)})
+
+    return [f"{path}/{name}" for name in sorted(listdir(path))]
+
+
+if __name__ == "__main__":
+    users_count = int(sys.argv[1]) if len(sys.argv) > 1 else 400000
+    words_count = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+
+    with TemporaryDirectory() as directory:
+        paths = write_files(directory, users_count, words_count)
+        print(f"{len(paths)} files, {sum(getsize(p) for p in paths) / 1024 / 1024:.1f} MB")
+
+        # The first load warms up the allocator, it is not measured
+        load_sequential(paths)
+
+        for cache in ["cached", "evicted"]:
+            for name, load in [("sequential", load_sequential), ("pool", load_pool)]:
+                if cache == "evicted" and not evict(paths):
+                    continue
+
+                start_time = perf_counter()
+                load(paths)
+                print(f"{cache:>7}, {name:>10}: {perf_counter() - start_time:.3f} s")
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# SCP-079-AVATAR - Get newly joined member's profile photo
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-AVATAR.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compare the memory and the difference time of set and IntSet message id sets
+# Usage: python3 -m benchmarks.id_sets [count]
+
+import sys
+import tracemalloc
+from random import Random
+from time import perf_counter
+
+from plugins.structures import IntSet
+
+
+def measure(deleted: list, messages: list, factory) -> tuple:
+    # Return the traced memory of the sets, and the seconds used to count the undeleted messages
+    tracemalloc.start()
+    deleted_ids = factory(deleted)
+    user_messages = [factory(mids) for mids in messages]
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = perf_counter()
+
+    for mids in user_messages:
+        len(mids - deleted_ids)
+
+    return memory, perf_counter() - start
+
+
+if __name__ == "__main__":
+    message_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    random = Random(79)
+
+    # One message in five of a group is deleted, a thousand users sent the rest
+    deleted_list = [mid for mid in range(message_count) if random.random() < 0.2]
+    message_lists = [[] for _ in range(1000)]
+
+    for message_id in range(message_count):
+        message_lists[random.randrange(1000)].append(message_id)
+
+    for name, function in [("set", set), ("IntSet", IntSet)]:
+        used, seconds = measure(deleted_list, message_lists, function)
+        print(f"{name:>6}: {used / message_count:6.2f} bytes/message in memory, "
+              f"{seconds * 1000:8.1f} ms to count the undeleted messages of all users")
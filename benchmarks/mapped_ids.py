@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# SCP-079-AVATAR - Get newly joined member's profile photo
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-AVATAR.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compare loading and querying a pickled set and a mapped id array
+# Usage: python3 -m benchmarks.mapped_ids [count]
+
+import sys
+import tracemalloc
+from os import remove, rmdir
+from random import Random
+from tempfile import mkdtemp
+from time import perf_counter
+
+from plugins.storage import read_ids, read_snapshot, write_ids, write_snapshot
+
+
+def measure(path: str, reader, queries: list) -> tuple:
+    # Return the seconds used to load, the traced memory, and the seconds used to query
+    tracemalloc.start()
+    start = perf_counter()
+    ids = reader(path)
+    loaded = perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = perf_counter()
+
+    for uid in queries:
+        uid in ids
+
+    return loaded, memory, perf_counter() - start
+
+
+if __name__ == "__main__":
+    id_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    random = Random(79)
+    id_set = {random.randrange(10 ** 10) for _ in range(id_count)}
+    query_list = [random.randrange(10 ** 10) for _ in range(100000)]
+    directory = mkdtemp()
+
+    write_snapshot(f"{directory}/set", id_set)
+    write_ids(f"{directory}/array", id_set)
+
+    for name, function in [("set", read_snapshot), ("array", read_ids)]:
+        load_time, used, query_time = measure(f"{directory}/{name}", function, query_list)
+        print(f"{name:>5}: {load_time * 1000:8.1f} ms to load, {used / id_count:6.2f} bytes/id in memory, "
+              f"{query_time * 1000:6.1f} ms for {len(query_list)} lookups")
+        remove(f"{directory}/{name}")
+
+    rmdir(directory)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# SCP-079-AVATAR - Get newly joined member's profile photo
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-AVATAR.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compare the per-text latency of the rule loop, the combined matcher and the literal prefilter
+# Usage: python3 -m benchmarks.regex_engine [rules] [texts]
+
+import sys
+from random import Random
+from string import ascii_lowercase
+from time import perf_counter
+
+from plugins.rules import RuleSet
+
+
+def get_rules(random: Random, count: int) -> list:
+    # Generate rules in the styles commonly used: spaced keywords, domains and keyword alternations
+    result = []
+
+    for i in range(count):
+        word = "".join(random.choice(ascii_lowercase) for _ in range(random.randint(4, 8)))
+
+        if i % 3 == 0:
+            result.append(r"\s*".join(word))
+        elif i % 3 == 1:
+            result.append(rf"{word}\.(com|net|org)")
+        else:
+            result.append(f"{word}|{word[::-1]}")
+
+    return result
+
+
+def get_texts(random: Random, count: int) -> list:
+    # Generate texts of random words, few of them hit any rule
+    return [" ".join("".join(random.choice(ascii_lowercase) for _ in range(random.randint(2, 7)))
+                     for _ in range(random.randint(5, 40)))
+            for _ in range(count)]
+
+
+def measure(rule_set: RuleSet, texts: list) -> tuple:
+    # Return the mean microseconds per text and the count of hits, both variants of the text are scanned
+    hits = 0
+    start = perf_counter()
+
+    for text in texts:
+        hits += bool(rule_set.search(text) or rule_set.search(text.replace(" ", "")))
+
+    return (perf_counter() - start) / len(texts) * 1000000, hits
+
+
+if __name__ == "__main__":
+    rule_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    text_count = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    random_rules = get_rules(Random(79), rule_count)
+    random_texts = get_texts(Random(80), text_count)
+
+    for name, combine, prefilter in [("loop", False, False), ("combined", True, False), ("prefilter", False, True)]:
+        start_time = perf_counter()
+        rules = RuleSet(random_rules, combine, prefilter)
+        compile_time = perf_counter() - start_time
+        latency, hit_count = measure(rules, random_texts)
+        print(f"{name:>9}: {latency:8.1f} us/text, {hit_count} hits, compiled in {compile_time * 1000:.0f} ms")
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# SCP-079-AVATAR - Get newly joined member's profile photo
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-AVATAR.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compare the throughput of checking long texts inline and in forked worker processes,
+# the texts go through the locking of the message handler, with the lock held only for the status and the record,
+# as check() does, or for the whole check, as it did before
+# Usage: python3 -m benchmarks.text_pool [rules] [texts] [words per text]
+
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from os import cpu_count
+from random import Random
+from string import ascii_lowercase
+from threading import Lock
+from time import perf_counter
+from typing import Optional
+
+from benchmarks.regex_engine import get_rules
+from plugins.rules import RuleSet
+
+# The workers are forked with the compiled rules, the same way the bot does it
+rule_set: Optional[RuleSet] = None
+
+# The message lock of the handler
+message_lock = Lock()
+
+
+def check_text(text: str) -> bool:
+    # Check both variants of the text, as the bot does
+    return bool(rule_set.search(text) or rule_set.search(text.replace(" ", "")))
+
+
+def handle(text: str, pool: Optional[ProcessPoolExecutor], whole: bool) -> bool:
+    # Handle a message the way check() does, the status checks and the record are stood in for by empty blocks
+    if whole:
+        with message_lock:
+            return pool.submit(check_text, text).result() if pool else check_text(text)
+
+    with message_lock:
+        pass
+
+    result = pool.submit(check_text, text).result() if pool else check_text(text)
+
+    with message_lock:
+        pass
+
+    return result
+
+
+def get_texts(random: Random, count: int, words: int) -> list:
+    # Generate long texts of random words, few of them hit any rule
+    return [" ".join("".join(random.choice(ascii_lowercase) for _ in range(random.randint(2, 7)))
+                     for _ in range(words))
+            for _ in range(count)]
+
+
+def measure(texts: list, workers: int, whole: bool) -> tuple:
+    # Return the texts checked per second and the count of hits, the texts come from 8 handler threads
+    start = perf_counter()
+
+    if not workers:
+        with ThreadPoolExecutor(8) as threads:
+            hits = sum(threads.map(lambda t: handle(t, None, whole), texts))
+
+        return len(texts) / (perf_counter() - start), hits
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("fork")) as pool:
+        # Start the workers first, forking is paid once per rule change in the bot
+        list(pool.map(check_text, [""] * workers))
+        start = perf_counter()
+
+        with ThreadPoolExecutor(8) as threads:
+            hits = sum(threads.map(lambda t: handle(t, pool, whole), texts))
+
+    return len(texts) / (perf_counter() - start), hits
+
+
+if __name__ == "__main__":
+    rule_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    text_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    word_count = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    random_rules = get_rules(Random(79), rule_count)
+    random_texts = get_texts(Random(80), text_count, word_count)
+    print(f"{cpu_count()} CPUs, {rule_count} rules, {text_count} texts of {word_count} words")
+
+    for name, prefilter in [("loop", False), ("prefilter", True)]:
+        rule_set = RuleSet(random_rules, False, prefilter)
+
+        for worker_count in [0, 1, 2, 4]:
+            for lock_name, whole_lock in [("record lock", False), ("whole lock", True)]:
+                throughput, hit_count = measure(random_texts, worker_count, whole_lock)
+                label = f"{worker_count} workers" if worker_count else "inline"
+                print(f"{name:>9}, {label:>9}, {lock_name:>11}: {throughput:8.1f} texts/s, {hit_count} hits")
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# SCP-079-AVATAR - Get newly joined member's profile photo
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-AVATAR.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compare the memory of dict user records and UserStatus records
+# Usage: python3 -m benchmarks.user_status [count]
+
+import sys
+import tracemalloc
+from copy import deepcopy
+from pickle import HIGHEST_PROTOCOL, dumps
+
+from plugins.structures import UserStatus
+
+default_user_status = {
+    "avatar": "",
+    "join": {},
+    "message": {},
+    "score": {project: 0.0 for project in UserStatus.projects}
+}
+
+
+def measure(count: int, factory) -> tuple:
+    # Return the traced memory and the pickled size of count records
+    tracemalloc.start()
+    user_ids = {}
+
+    for uid in range(count):
+        user_ids[uid] = factory(uid)
+
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return memory, len(dumps(user_ids, HIGHEST_PROTOCOL))
+
+
+def new_dict(uid: int) -> dict:
+    result = deepcopy(default_user_status)
+
+    # One user in ten has joined a group and sent a message
+    if uid % 10 == 0:
+        result["join"][-1001234567890] = 1512345678
+        result["message"][-1001234567890] = {uid}
+
+    return result
+
+
+def new_status(uid: int) -> UserStatus:
+    result = UserStatus()
+
+    if uid % 10 == 0:
+        result.set_join(-1001234567890, 1512345678)
+        result.add_message(-1001234567890, uid)
+
+    return result
+
+
+if __name__ == "__main__":
+    user_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    for name, function in [("dict", new_dict), ("UserStatus", new_status)]:
+        used, pickled = measure(user_count, function)
+        print(f"{name:>10}: {used / user_count:7.1f} bytes/user in memory, "
+              f"{pickled / user_count:7.1f} bytes/user pickled")
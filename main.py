@@ -26,7 +26,9 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from pyrogram import Client
 
 from plugins import glovar
-from plugins.functions.timers import backup_files, interval_hour_01, interval_min_15, reset_data, send_count
+from plugins.functions.file import flush_files
+from plugins.functions.timers import backup_files, interval_hour_01, interval_min_15, reorder_rules, report_rules
+from plugins.functions.timers import reset_data, send_count
 from plugins.functions.timers import update_admins, update_status, white_check
 
 # Enable logging
@@ -41,6 +43,7 @@ update_status(app, "online")
 
 # Timer
 scheduler = BackgroundScheduler(job_defaults={"misfire_grace_time": 60})
+scheduler.add_job(flush_files, "interval", seconds=glovar.time_save)
 scheduler.add_job(interval_min_15, "interval", [app], minutes=15)
 scheduler.add_job(interval_hour_01, "interval", [app], hours=1)
 scheduler.add_job(update_status, "cron", [app, "awake"], minute=randint(30, 34), second=randint(0, 59))
@@ -49,6 +52,13 @@ scheduler.add_job(send_count, "cron", [app], hour=21)
 scheduler.add_job(reset_data, "cron", [app], day=glovar.date_reset, hour=22)
 scheduler.add_job(update_admins, "cron", [app], hour=22, minute=30)
 scheduler.add_job(white_check, "cron", [app], hour=glovar.time_check)
+
+if glovar.regex_reorder:
+    scheduler.add_job(reorder_rules, "interval", minutes=15)
+
+if glovar.regex_budget:
+    scheduler.add_job(report_rules, "interval", [app], minutes=1)
+
 scheduler.start()
 
 # Hold
@@ -56,3 +66,7 @@ app.idle()
 
 # Stop
 app.stop()
+scheduler.shutdown()
+
+# Save data
+flush_files()
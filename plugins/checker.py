@@ -94,6 +94,26 @@ def check_custom(values: dict, broken: bool) -> str:
     return result
 
 
+def check_data(values: dict, broken: bool) -> str:
+    # Check all values in data section
+    result = ""
+
+    for key in values:
+        if key == "backend" and values[key] not in {"pickle", "sqlite"}:
+            result += f"[ERROR] [data] {key} - please choose pickle or sqlite\n"
+        elif key in {"backup_bundle", "mmap_ids"} and values[key] not in {False, True}:
+            result += f"[ERROR] [data] {key} - please fill a valid boolean value\n"
+        elif key not in {"backend", "backup_bundle", "mmap_ids"} and values[key] <= 0:
+            result += f"[ERROR] [data] {key} - should be a positive integer\n"
+
+        if not broken or not result:
+            continue
+
+        raise_error(result)
+
+    return result
+
+
 def check_emoji(values: dict, broken: bool) -> str:
     # Check all values in emoji section
     result = ""
@@ -182,6 +202,24 @@ def check_mode(values: dict, broken: bool) -> str:
     return result
 
 
+def check_regex(values: dict, broken: bool) -> str:
+    # Check all values in regex section
+    result = ""
+
+    for key in values:
+        if key in {"regex_budget", "regex_workers"} and values[key] < 0:
+            result += f"[ERROR] [regex] {key} - should be a non-negative number\n"
+        elif key not in {"regex_budget", "regex_workers"} and values[key] not in {False, True}:
+            result += f"[ERROR] [regex] {key} - please fill a valid boolean value\n"
+
+        if not broken or not result:
+            continue
+
+        raise_error(result)
+
+    return result
+
+
 def check_time(values: dict, broken: bool) -> str:
     # Check all values in time section
     result = ""
@@ -189,7 +227,9 @@ def check_time(values: dict, broken: bool) -> str:
     for key in values:
         if key == "date_reset" and values[key] in {"", "[DATA EXPUNGED]"}:
             result += f"[ERROR] [time] {key} - please fill a correct format string\n"
-        elif key in {"time_new", "time_old"} and values[key] <= 0:
+        elif (key in {"time_declared", "time_deleted", "time_new", "time_offload", "time_old", "time_save",
+                      "time_verdict"}
+              and values[key] <= 0):
             result += f"[ERROR] [time] {key} - should be a positive integer\n"
 
         if not broken or not result:
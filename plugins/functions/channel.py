@@ -18,7 +18,7 @@
 
 import logging
 from json import dumps
-from typing import List, Union
+from typing import Dict, List, Union
 
 from PIL.Image import Image
 from pyrogram import Client
@@ -150,7 +150,7 @@ def share_data_failed() -> bool:
     return result
 
 
-def share_regex_count(client: Client, word_type: str) -> bool:
+def share_regex_count(client: Client, word_type: str, words: Dict[str, int]) -> bool:
     # Use this function to share regex count to REGEX
     result = False
 
@@ -158,10 +158,10 @@ def share_regex_count(client: Client, word_type: str) -> bool:
         if not glovar.regex.get(word_type):
             return False
 
-        if not eval(f"glovar.{word_type}_words"):
+        if not words:
             return False
 
-        file = data_to_file(eval(f"glovar.{word_type}_words"))
+        file = data_to_file(words)
         result = share_data(
             client=client,
             receivers=["REGEX"],
@@ -17,14 +17,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+from array import array
 from datetime import datetime
 from html import escape
+from os.path import exists
 from random import choice, uniform
 from re import sub
 from string import ascii_letters, digits
+from sys import getsizeof
 from threading import Thread, Timer
 from time import localtime, sleep, strftime, time
-from typing import Any, Callable, Optional, Union
+from typing import Any, Callable, Optional, Set, Union
 from unicodedata import normalize
 
 from cryptography.fernet import Fernet
@@ -172,6 +175,45 @@ def get_int(text: str) -> Optional[int]:
     return result
 
 
+def get_memory_size(data: Any, sample: int = 64, seen: Set[int] = None) -> int:
+    # Get the approximate deep memory size of an object, only some items of a large container are measured
+    result = 0
+
+    try:
+        seen = set() if seen is None else seen
+
+        if id(data) in seen:
+            return 0
+
+        seen.add(id(data))
+        result = getsizeof(data)
+
+        if data is None or isinstance(data, (array, bool, bytearray, bytes, float, int, memoryview, str)):
+            return result
+
+        # Live containers are copied first, other threads may change them meanwhile
+        if isinstance(data, dict):
+            pairs = list(data.items())
+            items = [item for pair in pairs[:sample] for item in pair]
+            count = len(pairs) * 2
+        elif isinstance(data, (frozenset, list, set, tuple)):
+            items = list(data)
+            count = len(items)
+            items = items[:sample]
+        else:
+            items = [getattr(data, name) for cls in type(data).__mro__ for name in getattr(cls, "__slots__", ())
+                     if hasattr(data, name)]
+            items += list(getattr(data, "__dict__", {}).values())
+            count = len(items)
+
+        size = sum(get_memory_size(item, sample, seen) for item in items)
+        result += size * count // len(items) if items else 0
+    except Exception as e:
+        logger.warning(f"Get memory size error: {e}", exc_info=True)
+
+    return result
+
+
 def get_now() -> int:
     # Get time for now
     result = 0
@@ -184,6 +226,24 @@ def get_now() -> int:
     return result
 
 
+def get_readable_size(size: int) -> str:
+    # Get a readable size string
+    result = ""
+
+    try:
+        for unit in ["B", "KB", "MB"]:
+            if size < 1024:
+                return f"{size:.1f} {unit}"
+
+            size /= 1024
+
+        result = f"{size:.1f} GB"
+    except Exception as e:
+        logger.warning(f"Get readable size error: {e}", exc_info=True)
+
+    return result
+
+
 def get_readable_time(secs: int = 0, the_format: str = "%Y%m%d%H%M%S") -> str:
     # Get a readable time string
     result = ""
@@ -199,6 +259,29 @@ def get_readable_time(secs: int = 0, the_format: str = "%Y%m%d%H%M%S") -> str:
     return result
 
 
+def get_rss() -> int:
+    # Get the resident memory size of this process
+    result = 0
+
+    try:
+        if exists("/proc/self/statm"):
+            from os import sysconf
+
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * sysconf("SC_PAGE_SIZE")
+
+        # Not on Linux, use the peak size instead, the resource module only exists on Unix
+        from resource import RUSAGE_SELF, getrusage
+
+        result = getrusage(RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return 0
+    except Exception as e:
+        logger.warning(f"Get rss error: {e}", exc_info=True)
+
+    return result
+
+
 def get_text(message: Message, normal: bool = False, printable: bool = False, pure: bool = False) -> str:
     # Get message's text
     result = ""
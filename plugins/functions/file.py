@@ -17,17 +17,21 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from os import remove
-from os.path import exists
+import tarfile
+from hashlib import blake2b
+from os import listdir, mkdir, remove
+from os.path import exists, getsize
 from pickle import dump
-from shutil import copyfile
-from typing import Any
+from time import perf_counter
+from typing import Any, List, Optional, Set, Tuple
 
 from pyAesCrypt import decryptFile, encryptFile
 from pyrogram import Client
 
 from .. import glovar
-from .decorators import threaded
+from ..storage import append_journal, execute_user_record, read_ids, truncate_journal, write_ids, write_snapshot
+from ..storage import write_users, write_waits, write_watches
+from ..structures import SortedIdSet
 from .etc import random_str
 from .telegram import download_media
 
@@ -35,6 +39,24 @@ from .telegram import download_media
 logger = logging.getLogger(__name__)
 
 
+def bundle_files(file_list: List[Tuple[str, str]]) -> str:
+    # Pack files into a compressed archive in tmp directory, the files are named in the archive
+    result = ""
+
+    try:
+        file_path = get_new_path(".tar.gz")
+
+        with tarfile.open(file_path, "w:gz") as tar:
+            for name, path in file_list:
+                tar.add(path, name)
+
+        result = file_path
+    except Exception as e:
+        logger.warning(f"Bundle files error: {e}", exc_info=True)
+
+    return result
+
+
 def crypt_file(operation: str, file_in: str, file_out: str) -> bool:
     # Encrypt or decrypt a file
     result = False
@@ -89,6 +111,98 @@ def delete_file(path: str) -> bool:
     return result
 
 
+def flush_files() -> bool:
+    # Write all dirty global variables and pending journal records to files
+    result = False
+
+    merge_hits()
+
+    glovar.locks["flush"].acquire()
+
+    try:
+        with glovar.locks["save"]:
+            file_list = glovar.dirty_files
+            glovar.dirty_files = set()
+            dirty_shards = glovar.dirty_shards
+            glovar.dirty_shards = {}
+            journal_records = glovar.journal_records
+            glovar.journal_records = {}
+
+        if not file_list and not dirty_shards and not journal_records:
+            return True
+
+        start = perf_counter()
+
+        for file in sorted(file_list | set(dirty_shards) | set(journal_records)):
+            full = file in file_list
+            shards = None if full else dirty_shards.get(file, set())
+
+            if glovar.database and file in glovar.database_list:
+                result = save_database(file, journal_records.get(file, []), full)
+            elif file in glovar.mapped_files:
+                result = save_ids(file)
+            elif file in glovar.journal_list:
+                result = save_journal(file, journal_records.get(file, []), full)
+            elif file in glovar.shard_list:
+                result = save_shards(file, shards)
+            else:
+                result = save_file(file)
+
+            if result:
+                continue
+
+            with glovar.locks["save"]:
+                if shards is None or file not in glovar.shard_list:
+                    glovar.dirty_files.add(file)
+                else:
+                    glovar.dirty_shards.setdefault(file, set()).update(shards)
+
+        glovar.save_status["duration"] = perf_counter() - start
+        glovar.save_status["flushes"] += 1
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Flush files error: {e}", exc_info=True)
+    finally:
+        glovar.locks["flush"].release()
+
+    return result
+
+
+def flush_database(file: str) -> bool:
+    # Write the pending changes of a database-backed global variable, so queries see them, other files are left
+    result = False
+
+    glovar.locks["flush"].acquire()
+
+    try:
+        with glovar.locks["save"]:
+            full = file in glovar.dirty_files
+            glovar.dirty_files.discard(file)
+            records = glovar.journal_records.pop(file, [])
+
+        if not full and not records:
+            return True
+
+        result = save_database(file, records, full)
+
+        if result:
+            return True
+
+        # Not saved, the flusher tries again
+        with glovar.locks["save"]:
+            if full:
+                glovar.dirty_files.add(file)
+
+            glovar.journal_records[file] = records + glovar.journal_records.get(file, [])
+    except Exception as e:
+        logger.warning(f"Flush database {file} error: {e}", exc_info=True)
+    finally:
+        glovar.locks["flush"].release()
+
+    return result
+
+
 def get_downloaded_path(client: Client, file_id: str, file_ref: str) -> str:
     # Download file, get it's path on local machine
     result = ""
@@ -105,6 +219,24 @@ def get_downloaded_path(client: Client, file_id: str, file_ref: str) -> str:
     return result
 
 
+def get_file_hash(path: str) -> str:
+    # Get the content hash of a file
+    result = ""
+
+    try:
+        file_hash = blake2b(digest_size=16)
+
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                file_hash.update(chunk)
+
+        result = file_hash.hexdigest()
+    except Exception as e:
+        logger.warning(f"Get file hash error: {e}", exc_info=True)
+
+    return result
+
+
 def get_new_path(extension: str = "", prefix: str = "") -> str:
     # Get a new path in tmp directory
     result = ""
@@ -122,20 +254,286 @@ def get_new_path(extension: str = "", prefix: str = "") -> str:
     return result
 
 
-@threaded(daemon=False)
-def save(file: str) -> bool:
-    # Save a global variable to a file
+def get_shard(file: str, key: int) -> int:
+    # Get the shard of a key in a sharded global variable
+    result = 0
+
+    try:
+        if file == "deleted_ids":
+            result = key
+        else:
+            result = key % glovar.shards
+    except Exception as e:
+        logger.warning(f"Get shard error: {e}", exc_info=True)
+
+    return result
+
+
+def journal(file: str, record: tuple) -> bool:
+    # Record a mutation of a global variable, the flusher will append it to the journal
+    result = False
+
+    try:
+        if not glovar:
+            return False
+
+        with glovar.locks["save"]:
+            glovar.journal_records.setdefault(file, []).append(record)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Journal error: {e}", exc_info=True)
+
+    return result
+
+
+def merge_hits() -> bool:
+    # Add the regex hits counted by all threads to the word maps
+    result = False
+
+    glovar.locks["regex"].acquire()
+
+    try:
+        hits = glovar.regex_hits.merge()
+
+        for word_type in hits:
+            words = eval(f"glovar.{word_type}_words")
+
+            # Rules removed since the hits were counted are skipped
+            for word in hits[word_type]:
+                if word in words:
+                    words[word] = words[word] + hits[word_type][word]
+
+            save(f"{word_type}_words")
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Merge hits error: {e}", exc_info=True)
+    finally:
+        glovar.locks["regex"].release()
+
+    return result
+
+
+def save(file: str, key: int = None) -> bool:
+    # Mark a global variable, or only the shard of the key, as dirty, the flusher will save it later
     result = False
 
     try:
         if not glovar:
             return False
 
-        with open(f"data/.{file}", "wb") as f:
-            dump(eval(f"glovar.{file}"), f)
+        sharded = key is not None and file in glovar.shard_list
+
+        with glovar.locks["save"]:
+            if sharded:
+                dirty_set = glovar.dirty_shards.setdefault(file, set())
+                item = get_shard(file, key)
+            else:
+                dirty_set = glovar.dirty_files
+                item = file
 
-        result = copyfile(f"data/.{file}", f"data/{file}") or True
+            if item in dirty_set or file in glovar.dirty_files:
+                glovar.save_status["coalesced"] += 1
+            else:
+                dirty_set.add(item)
+
+        result = True
     except Exception as e:
         logger.warning(f"Save error: {e}", exc_info=True)
 
     return result
+
+
+def save_database(file: str, records: List[tuple], full: bool) -> bool:
+    # Save a global variable to the database
+    result = False
+
+    glovar.locks["database"].acquire()
+
+    try:
+        start = perf_counter()
+        if file == "user_ids" and full:
+            result = write_users(glovar.database, glovar.user_ids)
+        elif file == "user_ids":
+            with glovar.database:
+                glovar.database.execute("BEGIN")
+
+                for record in records:
+                    execute_user_record(glovar.database, record)
+
+            result = True
+        elif file == "watch_ids":
+            result = write_watches(glovar.database, glovar.watch_ids)
+        elif file == "white_wait_ids":
+            result = write_waits(glovar.database, glovar.white_wait_ids)
+
+        glovar.save_times[file] = perf_counter() - start
+        glovar.save_status["saves"] += 1
+    except Exception as e:
+        logger.warning(f"Save database {file} error: {e}", exc_info=True)
+    finally:
+        glovar.locks["database"].release()
+
+    return result
+
+
+def save_file(file: str) -> bool:
+    # Save a global variable to a file
+    result = False
+
+    try:
+        start = perf_counter()
+        size = write_snapshot(f"data/{file}", eval(f"glovar.{file}"))
+
+        # The id sets are in the snapshot now, remove the id arrays written with the mmap_ids option
+        for name in [name for name in glovar.array_list if name.split(".")[0] == file]:
+            delete_file(f"data/{name}.ids")
+
+        glovar.save_times[file] = perf_counter() - start
+        glovar.save_status["bytes"] += size
+        glovar.save_status["saves"] += 1
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Save file {file} error: {e}", exc_info=True)
+
+    return result
+
+
+def save_ids(file: str) -> bool:
+    # Save a global variable, its large id sets are written to id arrays and mapped again
+    result = False
+
+    try:
+        start = perf_counter()
+        data = eval(f"glovar.{file}")
+        size = 0
+
+        for name in [name for name in glovar.mapped_list if name.split(".")[0] == file]:
+            key = name.partition(".")[2]
+            ids = data[key] if key else data
+            path = f"data/{name}.ids"
+
+            # A plain set, assigned by a reset or a rollback, is mapped on the next start
+            if not isinstance(ids, SortedIdSet):
+                size += write_ids(path, list(ids))
+                continue
+
+            with ids.lock:
+                size += write_ids(path, ids)
+                ids.rebase(read_ids(path))
+
+        # Other values are saved in the snapshot as usual
+        if isinstance(data, dict):
+            data = {key: set() if f"{file}.{key}" in glovar.mapped_list else data[key] for key in list(data)}
+            size += write_snapshot(f"data/{file}", data)
+        else:
+            delete_file(f"data/{file}")
+
+        glovar.save_times[file] = perf_counter() - start
+        glovar.save_status["bytes"] += size
+        glovar.save_status["saves"] += 1
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Save ids {file} error: {e}", exc_info=True)
+
+    return result
+
+
+def save_journal(file: str, records: List[tuple], full: bool) -> bool:
+    # Append records to a global variable's journal, compact the journal if necessary
+    result = False
+
+    try:
+        path = f"data/{file}.journal"
+        size = exists(path) and getsize(path)
+
+        if records:
+            size = append_journal(path, records)
+
+        if records and not size:
+            with glovar.locks["save"]:
+                glovar.journal_records[file] = records + glovar.journal_records.get(file, [])
+
+            return False
+
+        # Records without a user ID change every shard
+        if any(len(record) == 1 for record in records):
+            full = True
+        elif file in glovar.shard_list:
+            glovar.journal_shards.setdefault(file, set()).update(get_shard(file, record[1]) for record in records)
+
+        if not full and size < glovar.journal_size:
+            return True
+
+        # Compact, the snapshot already contains every record in the journal
+        if file in glovar.shard_list:
+            shards = glovar.journal_shards.pop(file, set())
+            result = save_shards(file, None if full else shards) and truncate_journal(path)
+
+            # The journal is kept, so the shards it changed are saved again by the next compaction
+            if not result:
+                glovar.journal_shards.setdefault(file, set()).update(shards)
+
+            if not result and full:
+                with glovar.locks["save"]:
+                    glovar.dirty_files.add(file)
+        else:
+            result = save_file(file) and truncate_journal(path)
+    except Exception as e:
+        logger.warning(f"Save journal {file} error: {e}", exc_info=True)
+
+    return result
+
+
+def save_shards(file: str, shards: Optional[Set[int]]) -> bool:
+    # Save some shards, or all shards if not specified, of a global variable to files
+    result = False
+
+    try:
+        start = perf_counter()
+        path = f"data/{file}.d"
+        not exists(path) and mkdir(path)
+
+        data = eval(f"glovar.{file}")
+        keys = list(data)
+        full = shards is None
+
+        if full:
+            shards = ({get_shard(file, key) for key in keys}
+                      | {int(name) for name in listdir(path) if not name.endswith(".tmp")})
+
+        groups = {shard: {} for shard in shards}
+
+        for key in keys:
+            shard = get_shard(file, key)
+            value = data.get(key)
+
+            if shard not in groups or value is None:
+                continue
+
+            groups[shard][key] = value
+
+        size = 0
+
+        for shard in groups:
+            if groups[shard]:
+                size += write_snapshot(f"{path}/{shard}", groups[shard])
+            else:
+                delete_file(f"{path}/{shard}")
+
+        # The whole map is in shards now, remove the file of older versions
+        if full:
+            delete_file(f"data/{file}")
+
+        glovar.save_times[file] = perf_counter() - start
+        glovar.save_status["bytes"] += size
+        glovar.save_status["saves"] += 1
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Save shards {file} error: {e}", exc_info=True)
+
+    return result
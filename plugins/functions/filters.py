@@ -18,16 +18,21 @@
 
 import logging
 import re
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
 from copy import deepcopy
+from hashlib import blake2b
+from multiprocessing import get_all_start_methods, get_context
 from string import ascii_lowercase, punctuation
-from typing import Match, Optional, Union
+from threading import Lock
+from typing import List, Match, Optional, Set, Tuple, Union
 
 from pyrogram import CallbackQuery, Client, Filters, Message, User
 from zhon.hanzi import punctuation as punctuation_zh
 
 from .. import glovar
+from ..rules import CategoryMatcher, RuleSet
+from ..structures import HitCounter, VerdictCache
 from .etc import get_full_name, get_now, get_text, t2t
-from .file import save
 from .ids import init_group_id
 from .telegram import get_user_full
 
@@ -263,6 +268,44 @@ white_user = Filters.create(
 )
 
 
+def build_rule_set(word_type: str) -> RuleSet:
+    # Compile the rules of a word type and publish them, quarantined rules are left out,
+    # the caller holds the regex lock, readers keep using the old rule set until it is replaced
+    result = None
+
+    try:
+        quarantined = glovar.quarantined_rules.get(word_type, set())
+        words = [word for word in list(eval(f"glovar.{word_type}_words")) if word not in quarantined]
+        result = RuleSet(words, glovar.regex_combine, glovar.regex_prefilter, bool(glovar.regex_budget))
+        glovar.rule_sets[word_type] = result
+    except Exception as e:
+        logger.warning(f"Build rule set error: {e}", exc_info=True)
+
+    return result
+
+
+def classify_text(kind: str, text: str, ocr: bool) -> Tuple[bool, List[Tuple[str, str]], List[tuple]]:
+    # Check the text in a worker process, return the verdict, the hits and the rules quarantined meanwhile
+    result = (False, [], [])
+
+    try:
+        glovar.regex_hits.start()
+
+        if kind == "ban":
+            verdict = get_ban_verdict(text, ocr)
+        else:
+            verdict = is_nm_text(text)
+
+        hits = glovar.regex_hits.stop()
+        reports = glovar.quarantine_reports
+        glovar.quarantine_reports = []
+        result = (verdict, hits, reports)
+    except Exception as e:
+        logger.warning(f"Classify text error: {e}", exc_info=True)
+
+    return result
+
+
 def detect_nospam(client: Client, gid: int, user: User) -> bool:
     # NOSPAM detection:
     result = False
@@ -276,9 +319,7 @@ def detect_nospam(client: Client, gid: int, user: User) -> bool:
             return False
 
         # Check name
-        name = get_full_name(user, True, True, True)
-
-        if name and is_nm_text(name):
+        if is_nm_user(user):
             return True
 
         # Check bio
@@ -297,31 +338,30 @@ def detect_nospam(client: Client, gid: int, user: User) -> bool:
     return result
 
 
-def is_ad_text(text: str, ocr: bool, matched: str = "") -> str:
-    # Check if the text is ad text
-    result = ""
+def get_ad_matcher() -> CategoryMatcher:
+    # Get the matcher of all ad categories without locking, it is built again once the rules of any category change
+    result = glovar.ad_matcher
 
     try:
-        if not text:
-            return ""
+        rule_sets = tuple(get_rule_set(f"ad{c}") for c in ascii_lowercase)
 
-        for c in ascii_lowercase:
-            if c == matched:
-                continue
+        if result is not None and result.rule_sets == rule_sets:
+            return result
 
-            if not is_regex_text(f"ad{c}", text, ocr):
-                continue
+        with glovar.locks["regex"]:
+            result = glovar.ad_matcher
 
-            result = c
-            break
+            if result is None or result.rule_sets != rule_sets:
+                result = CategoryMatcher(dict(zip(ascii_lowercase, rule_sets)), glovar.regex_prefilter)
+                glovar.ad_matcher = result
     except Exception as e:
-        logger.warning(f"Is ad text error: {e}", exc_info=True)
+        logger.warning(f"Get ad matcher error: {e}", exc_info=True)
 
     return result
 
 
-def is_ban_text(text: str, ocr: bool, message: Message = None) -> bool:
-    # Check if the text is ban text
+def get_ban_verdict(text: str, ocr: bool) -> bool:
+    # Run the rules to check if the text is ban text
     result = False
 
     try:
@@ -336,7 +376,7 @@ def is_ban_text(text: str, ocr: bool, message: Message = None) -> bool:
             return True
 
         # emoji + con
-        emoji = is_emoji("ad", text, message)
+        emoji = is_emoji("ad", text)
 
         if emoji and con:
             return True
@@ -352,11 +392,199 @@ def is_ban_text(text: str, ocr: bool, message: Message = None) -> bool:
             return True
 
         # ad_ + ad_
-        if not ad:
-            return False
+        result = len(ad) > 1
+    except Exception as e:
+        logger.warning(f"Get ban verdict error: {e}", exc_info=True)
+
+    return result
+
+
+def get_pool_verdict(kind: str, text: str, ocr: bool = False) -> Optional[bool]:
+    # Check a long text in the process pool and wait for the verdict, return None if the pool is not used or does not
+    # answer in time, so the text is checked in this thread
+    result = None
+    pool = None
+
+    try:
+        if not glovar.regex_workers or len(text) < glovar.limit_offload:
+            return None
+
+        pool = get_text_pool()
+
+        if pool is None:
+            return None
+
+        verdict, hits, reports = pool.submit(classify_text, kind, text, ocr).result(glovar.time_offload)
+
+        # The hits and the quarantined rules of the worker are applied here
+        for word_type, word in hits:
+            glovar.regex_hits.add(word_type, word)
+
+        for word_type, word, seconds in reports:
+            quarantine_rule(word_type, word, seconds)
+
+        result = verdict
+    except FutureTimeoutError:
+        logger.warning(f"Get pool verdict timed out after {glovar.time_offload}s")
+
+        # A worker may be stuck, the pool is stopped and forked again on the next use
+        stop_text_pool(pool)
+    except Exception as e:
+        logger.warning(f"Get pool verdict error: {e}", exc_info=True)
+
+        # A broken pool is forked again on the next use
+        glovar.text_pool_version = -1
+
+    return result
+
+
+def get_rule_set(word_type: str) -> RuleSet:
+    # Get the published rule set of a word type without locking, rules of lazy word maps are compiled on first use
+    result = glovar.rule_sets.get(word_type)
+
+    try:
+        if result is not None:
+            return result
+
+        with glovar.locks["regex"]:
+            result = glovar.rule_sets.get(word_type) or build_rule_set(word_type)
+    except Exception as e:
+        logger.warning(f"Get rule set error: {e}", exc_info=True)
+
+    return result
+
+
+def get_slow_rules(limit: int = 5) -> List[Tuple[str, str, float, int]]:
+    # Get the rules that took the most time while profiling, with their word types, total seconds and calls
+    result = []
+
+    try:
+        for word_type, profile in list(glovar.regex_profiles.items()):
+            result += [(word_type, word, stats[0], stats[1]) for word, stats in list(profile.items())]
+
+        result = sorted(result, key=lambda rule: rule[2], reverse=True)[:limit]
+    except Exception as e:
+        logger.warning(f"Get slow rules error: {e}", exc_info=True)
+
+    return result
+
+
+def get_text_pool() -> Optional[ProcessPoolExecutor]:
+    # Get the process pool, a new pool is forked once the rules change, so the workers have the current rules
+    result = glovar.text_pool
+
+    try:
+        if result is not None and glovar.text_pool_version == glovar.regex_version:
+            return result
+
+        # Workers are forked with the compiled rules, other start methods would load all data again
+        if "fork" not in get_all_start_methods():
+            return None
+
+        with glovar.locks["pool"]:
+            if glovar.text_pool is not None and glovar.text_pool_version == glovar.regex_version:
+                return glovar.text_pool
+
+            # Compile all the rules the workers use before they are forked, so they never take the regex lock
+            version = glovar.regex_version
+
+            for word_type in ["ad", "ban", "bio", "con", "nm"]:
+                get_rule_set(word_type)
+
+            get_ad_matcher()
+
+            old_pool = glovar.text_pool
+            result = ProcessPoolExecutor(max_workers=glovar.regex_workers, mp_context=get_context("fork"),
+                                         initializer=init_text_worker)
+            glovar.text_pool = result
+            glovar.text_pool_version = version
+
+            if old_pool is not None:
+                old_pool.shutdown(wait=False)
+    except Exception as e:
+        logger.warning(f"Get text pool error: {e}", exc_info=True)
+
+    return result
 
-        ad = is_ad_text(text, ocr, ad)
-        result = bool(ad)
+
+def init_text_worker() -> bool:
+    # Replace the state a worker process copied from the parent, other threads of the parent may have held its locks
+    result = False
+
+    try:
+        glovar.locks = {name: Lock() for name in glovar.locks}
+        glovar.ban_verdicts = VerdictCache(glovar.limit_verdict, glovar.time_verdict)
+        glovar.name_verdicts = VerdictCache(glovar.limit_verdict, glovar.time_verdict)
+        glovar.quarantine_reports = []
+        glovar.regex_hits = HitCounter()
+        glovar.regex_profile = False
+        glovar.regex_workers = 0
+        result = True
+    except Exception as e:
+        logger.warning(f"Init text worker error: {e}", exc_info=True)
+
+    return result
+
+
+def is_ad_text(text: str, ocr: bool, limit: int = 2) -> Set[str]:
+    # Check if the text is ad text, return the hit ad categories
+    result = set()
+
+    try:
+        if not text:
+            return set()
+
+        text = re.sub(r"\s{2,}", " ", text)
+        stripped = re.sub(r"\s", "", text) if " " in text else ""
+
+        ad_matcher = get_ad_matcher()
+
+        if glovar.regex_profile:
+            profiles = {c: glovar.regex_profiles.setdefault(f"ad{c}", {}) for c in ascii_lowercase}
+        else:
+            profiles = None
+
+        slow = []
+        hits = ad_matcher.search(text, stripped, ocr, limit, profiles, glovar.regex_budget, slow)
+
+        for c in hits:
+            glovar.regex_hits.add(f"ad{c}", hits[c][0])
+
+        for c, word, seconds in slow:
+            quarantine_rule(f"ad{c}", word, seconds)
+
+        result = set(hits)
+    except Exception as e:
+        logger.warning(f"Is ad text error: {e}", exc_info=True)
+
+    return result
+
+
+def is_ban_text(text: str, ocr: bool) -> bool:
+    # Check if the text is ban text, verdicts of the same text are cached until the rules change
+    result = False
+
+    try:
+        now = get_now()
+        key = (glovar.regex_version, ocr, blake2b(text.encode(), digest_size=16).digest())
+        cached = glovar.ban_verdicts.get(key, now)
+
+        # Count the hits again, as if the rules were run
+        if cached is not None:
+            result, hits = cached
+
+            for word_type, word in hits:
+                glovar.regex_hits.add(word_type, word)
+
+            return result
+
+        glovar.regex_hits.start()
+        result = get_pool_verdict("ban", text, ocr)
+
+        if result is None:
+            result = get_ban_verdict(text, ocr)
+
+        glovar.ban_verdicts.set(key, (result, tuple(glovar.regex_hits.stop())), now)
     except Exception as e:
         logger.warning(f"Is ban text error: {e}", exc_info=True)
 
@@ -436,7 +664,8 @@ def is_declared_message_id(gid: int, mid: int) -> bool:
     result = False
 
     try:
-        result = mid in glovar.declared_message_ids.get(gid, set())
+        declared_ids = glovar.declared_message_ids.get(gid)
+        result = bool(declared_ids) and declared_ids.contains(mid, get_now())
     except Exception as e:
         logger.warning(f"Is declared message id error: {e}", exc_info=True)
 
@@ -501,12 +730,12 @@ def is_high_score_user(user: Union[int, User], high: bool = True) -> float:
         else:
             uid = user.id
 
-        user_status = glovar.user_ids.get(uid, {})
+        user_status = glovar.user_ids.get(uid)
 
         if not user_status:
             return 0.0
 
-        score = sum(user_status["score"].values())
+        score = user_status.total_score()
 
         if not high:
             return score
@@ -524,6 +753,11 @@ def is_nm_text(text: str) -> bool:
     result = False
 
     try:
+        verdict = get_pool_verdict("nm", text)
+
+        if verdict is not None:
+            return verdict
+
         if (is_regex_text("nm", text)
                 or is_regex_text("bio", text)
                 or is_ban_text(text, False)):
@@ -534,6 +768,35 @@ def is_nm_text(text: str) -> bool:
     return result
 
 
+def is_nm_user(user: User) -> bool:
+    # Check if the user's name is nm text, verdicts are cached until the name or the rules change
+    result = False
+
+    try:
+        now = get_now()
+        name = f"{user.is_deleted}\n{user.first_name}\n{user.last_name}"
+        key = (glovar.regex_version, user.id, blake2b(name.encode(), digest_size=16).digest())
+        cached = glovar.name_verdicts.get(key, now)
+
+        # Count the hits again, as if the rules were run
+        if cached is not None:
+            result, hits = cached
+
+            for word_type, word in hits:
+                glovar.regex_hits.add(word_type, word)
+
+            return result
+
+        glovar.regex_hits.start()
+        name = get_full_name(user, True, True, True)
+        result = bool(name) and is_nm_text(name)
+        glovar.name_verdicts.set(key, (result, tuple(glovar.regex_hits.stop())), now)
+    except Exception as e:
+        logger.warning(f"Is nm user error: {e}", exc_info=True)
+
+    return result
+
+
 def is_regex_text(word_type: str, text: str, ocr: bool = False, again: bool = False) -> Optional[Match]:
     # Check if the text hit the regex rules
     result = None
@@ -549,23 +812,18 @@ def is_regex_text(word_type: str, text: str, ocr: bool = False, again: bool = Fa
         else:
             return None
 
-        with glovar.locks["regex"]:
-            words = list(eval(f"glovar.{word_type}_words"))
-
-        for word in words:
-            if ocr and "(?# nocr)" in word:
-                continue
+        rule_set = get_rule_set(word_type)
+        profile = glovar.regex_profiles.setdefault(word_type, {}) if glovar.regex_profile else None
+        slow = []
+        hit = rule_set.search(text, ocr, profile, glovar.regex_budget, slow)
 
-            result = re.search(word, text, re.I | re.S | re.M)
+        for word, seconds in slow:
+            quarantine_rule(word_type, word, seconds)
 
-            # Count and return
-            if not result:
-                continue
-
-            count = eval(f"glovar.{word_type}_words").get(word, 0)
-            count += 1
-            eval(f"glovar.{word_type}_words")[word] = count
-            save(f"{word_type}_words")
+        # Count and return, the hits are merged into the word map when the files are flushed
+        if hit:
+            word, result = hit
+            glovar.regex_hits.add(word_type, word)
 
             return result
 
@@ -621,3 +879,48 @@ def is_valid_character(c: str) -> bool:
         logger.warning(f"Is valid character error: {e}", exc_info=True)
 
     return result
+
+
+def quarantine_rule(word_type: str, word: str, seconds: float) -> bool:
+    # Stop using a rule that ran over the time budget, it is reported to the debug channel later
+    result = False
+
+    try:
+        with glovar.locks["regex"]:
+            if word in glovar.quarantined_rules.get(word_type, set()):
+                return False
+
+            glovar.quarantined_rules.setdefault(word_type, set()).add(word)
+            build_rule_set(word_type)
+            glovar.regex_version += 1
+            glovar.quarantine_reports.append((word_type, word, seconds))
+
+        logger.warning(f"Quarantine rule {word_type} {word!r}: {seconds * 1000:.1f} ms")
+        result = True
+    except Exception as e:
+        logger.warning(f"Quarantine rule error: {e}", exc_info=True)
+
+    return result
+
+
+def stop_text_pool(pool: ProcessPoolExecutor) -> bool:
+    # Stop a process pool that does not answer, its workers are terminated, so a stuck search does not go on
+    result = False
+
+    try:
+        with glovar.locks["pool"]:
+            if glovar.text_pool is pool:
+                glovar.text_pool = None
+                glovar.text_pool_version = -1
+
+        # The executor has no public way to stop a running worker, other threads waiting on it check inline
+        for process in list((pool._processes or {}).values()):
+            process.terminate()
+
+        pool.shutdown(wait=False)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Stop text pool error: {e}", exc_info=True)
+
+    return result
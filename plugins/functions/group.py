@@ -43,7 +43,7 @@ def leave_group(client: Client, gid: int) -> bool:
         save("admin_ids")
 
         glovar.deleted_ids.pop(gid, set())
-        save("deleted_ids")
+        save("deleted_ids", gid)
 
         glovar.trust_ids.pop(gid, set())
         save("trust_ids")
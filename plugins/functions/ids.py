@@ -17,10 +17,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from copy import deepcopy
 
 from .. import glovar
-from .file import save
+from ..structures import RecentIds, UserStatus, WindowedIds
+from .file import journal, save
 
 # Enable logging
 logger = logging.getLogger(__name__)
@@ -39,15 +39,15 @@ def init_group_id(gid: int) -> bool:
             save("admin_ids")
 
         if glovar.deleted_ids.get(gid) is None:
-            glovar.deleted_ids[gid] = set()
-            save("deleted_ids")
+            glovar.deleted_ids[gid] = WindowedIds()
+            save("deleted_ids", gid)
 
         if glovar.trust_ids.get(gid) is None:
             glovar.trust_ids[gid] = set()
             save("trust_ids")
 
         if glovar.declared_message_ids.get(gid) is None:
-            glovar.declared_message_ids[gid] = set()
+            glovar.declared_message_ids[gid] = RecentIds(glovar.limit_declared, glovar.time_declared)
 
         result = True
     except Exception as e:
@@ -64,8 +64,8 @@ def init_user_id(uid: int) -> bool:
         if glovar.user_ids.get(uid) is not None:
             return True
 
-        glovar.user_ids[uid] = deepcopy(glovar.default_user_status)
-        save("user_ids")
+        glovar.user_ids[uid] = UserStatus()
+        journal("user_ids", ("init", uid))
 
         result = True
     except Exception as e:
@@ -17,8 +17,6 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import pickle
-from copy import deepcopy
 from json import loads
 from subprocess import run, PIPE
 from typing import Any
@@ -26,13 +24,16 @@ from typing import Any
 from pyrogram import Client, Message
 
 from .. import glovar
+from ..storage import read_snapshot
+from ..structures import UserStatus, convert_user_ids, convert_windowed_ids
 from .channel import send_help, share_data
-from .etc import code, crypt_str, general_link, get_int, get_readable_time, get_text, lang, mention_id, thread
-from .file import crypt_file, data_to_file, delete_file, get_new_path, get_downloaded_path, save
-from .filters import is_high_score_user
+from .etc import code, crypt_str, general_link, get_int, get_memory_size, get_now, get_readable_size
+from .etc import get_readable_time, get_rss, get_text, lang, mention_id, thread
+from .file import crypt_file, data_to_file, delete_file, get_new_path, get_downloaded_path, get_shard, journal, save
+from .filters import build_rule_set, get_slow_rules, is_high_score_user
 from .ids import init_group_id, init_user_id
 from .timers import update_admins
-from .user import get_user, remove_new_users
+from .user import get_user, get_watching_count, remove_new_users
 
 # Enable logging
 logger = logging.getLogger(__name__)
@@ -133,11 +134,11 @@ def receive_captcha_kicked_user(data: dict) -> bool:
             return False
 
         # Check user status
-        if not glovar.user_ids.get(uid, {}):
+        if not glovar.user_ids.get(uid):
             return True
 
-        glovar.user_ids[uid]["join"].pop(gid, 0)
-        save("user_ids")
+        glovar.user_ids[uid].pop_join(gid)
+        journal("user_ids", ("join_pop", uid, gid))
 
         result = True
     except Exception as e:
@@ -167,9 +168,11 @@ def receive_captcha_kicked_users(client: Client, message: Message, data: int) ->
 
         # Remove group status
         for uid in uids:
-            glovar.user_ids.get(uid, {}) and glovar.user_ids[uid]["join"].pop(gid, 0)
+            if not glovar.user_ids.get(uid):
+                continue
 
-        save("user_ids")
+            glovar.user_ids[uid].pop_join(gid)
+            journal("user_ids", ("join_pop", uid, gid))
 
         result = True
     except Exception as e:
@@ -211,11 +214,10 @@ def receive_clear_data(client: Client, data_type: str, data: dict) -> bool:
         elif data_type == "user":
             if the_type == "all":
                 glovar.user_ids = {}
+                journal("user_ids", ("clear",))
             elif the_type == "new":
                 remove_new_users()
 
-            save("user_ids")
-
         # Clear watch data
         elif data_type == "watch":
             if the_type == "all":
@@ -277,7 +279,7 @@ def receive_declared_message(data: dict) -> bool:
         if not init_group_id(gid):
             return False
 
-        glovar.declared_message_ids[gid].add(mid)
+        glovar.declared_message_ids[gid].add(mid, get_now())
 
         result = True
     except Exception as e:
@@ -311,8 +313,7 @@ def receive_file_data(client: Client, message: Message, decrypt: bool = True) ->
             path_decrypted = ""
             path_final = path
 
-        with open(path_final, "rb") as f:
-            result = pickle.load(f)
+        result = read_snapshot(path_final)
 
         for f in {path, path_decrypted}:
             thread(delete_file, (f,))
@@ -337,9 +338,8 @@ def receive_flood_score(client: Client, message: Message) -> bool:
         user_list = [uid for uid in list(users) if init_user_id(uid)]
 
         for uid in user_list:
-            glovar.user_ids[uid]["score"]["captcha"] = users[uid]
-
-        save("user_ids")
+            glovar.user_ids[uid].set_score("captcha", users[uid])
+            journal("user_ids", ("score", uid, "captcha", users[uid]))
 
         result = True
     except Exception as e:
@@ -350,6 +350,38 @@ def receive_flood_score(client: Client, message: Message) -> bool:
     return result
 
 
+def receive_profile(client: Client, data: dict) -> bool:
+    # Receive the switch of regex profiling
+    result = False
+
+    try:
+        # Basic data
+        aid = data["admin_id"]
+        enabled = bool(data["profile"])
+
+        # Log the report of the last profile, a new profile starts empty
+        for word_type, word, seconds, calls in get_slow_rules(10):
+            logger.warning(f"Slow rule {word_type} {word!r}: {seconds * 1000:.1f} ms in {calls} calls")
+
+        if enabled:
+            glovar.regex_profiles = {}
+
+        glovar.regex_profile = enabled
+
+        # Send debug message
+        text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
+                f"{lang('admin_project')}{lang('colon')}{mention_id(aid)}\n"
+                f"{lang('action')}{lang('colon')}{code(lang('profile'))}\n"
+                f"{lang('more')}{lang('colon')}{code(lang('enabled') if enabled else lang('disabled'))}\n")
+        send_help(client, glovar.debug_channel_id, text)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Receive profile error: {e}", exc_info=True)
+
+    return result
+
+
 def receive_refresh(client: Client, data: int) -> bool:
     # Receive refresh
     result = False
@@ -375,23 +407,23 @@ def receive_refresh(client: Client, data: int) -> bool:
 
 
 def receive_regex(client: Client, message: Message, data: str) -> bool:
-    # Receive regex
+    # Receive regex, the file is downloaded before locking, and the new rule set replaces the old one at once
     result = False
 
-    glovar.locks["regex"].acquire()
+    file_name = data
+    word_type = file_name.split("_")[0]
 
-    try:
-        file_name = data
-        word_type = file_name.split("_")[0]
+    if word_type not in glovar.regex:
+        return False
 
-        if word_type not in glovar.regex:
-            return False
+    words_data = receive_file_data(client, message)
 
-        words_data = receive_file_data(client, message)
+    if words_data is None:
+        return False
 
-        if words_data is None:
-            return False
+    glovar.locks["regex"].acquire()
 
+    try:
         pop_set = set(eval(f"glovar.{file_name}")) - set(words_data)
         new_set = set(words_data) - set(eval(f"glovar.{file_name}"))
 
@@ -402,13 +434,15 @@ def receive_regex(client: Client, message: Message, data: str) -> bool:
             eval(f"glovar.{file_name}")[word] = 0
 
         save(file_name)
+        build_rule_set(word_type)
+        glovar.regex_version += 1
 
-        # Regenerate special characters dictionary if possible
+        # Regenerate special characters dictionary if possible, the new dictionary is filled before it is published
         if file_name not in {"spc_words", "spe_words"}:
             return False
 
         special = file_name.split("_")[0]
-        exec(f"glovar.{special}_dict = {{}}")
+        special_dict = {}
 
         for rule in words_data:
             # Check keys
@@ -423,7 +457,9 @@ def receive_regex(client: Client, message: Message, data: str) -> bool:
             value = rule.split("?#")[1][1]
 
             for k in keys:
-                eval(f"glovar.{special}_dict")[k] = value
+                special_dict[k] = value
+
+        setattr(glovar, f"{special}_dict", special_dict)
 
         result = True
     except Exception as e:
@@ -453,8 +489,8 @@ def receive_remove_bad(data: dict) -> bool:
             glovar.watch_ids["ban"].pop(the_id, {})
             glovar.watch_ids["delete"].pop(the_id, {})
             save("watch_ids")
-            glovar.user_ids[the_id] = deepcopy(glovar.default_user_status)
-            save("user_ids")
+            glovar.user_ids[the_id] = UserStatus()
+            journal("user_ids", ("reset", the_id))
 
         save("bad_ids")
 
@@ -507,8 +543,8 @@ def receive_remove_score(data: int) -> bool:
         if not glovar.user_ids.get(uid):
             return False
 
-        glovar.user_ids[uid] = deepcopy(glovar.default_user_status)
-        save("user_ids")
+        glovar.user_ids[uid] = UserStatus()
+        journal("user_ids", ("reset", uid))
 
         result = True
     except Exception as e:
@@ -561,8 +597,8 @@ def receive_remove_white(data: int) -> bool:
         save("white_wait_ids")
 
         # User ids
-        glovar.user_ids[uid]["message"] = {}
-        save("user_ids")
+        glovar.user_ids[uid].clear_message()
+        journal("user_ids", ("message_clear", uid))
 
         result = True
     except Exception as e:
@@ -586,8 +622,32 @@ def receive_rollback(client: Client, message: Message, data: dict) -> bool:
         if the_data is None:
             return False
 
-        exec(f"glovar.{the_type} = the_data")
-        save(the_type)
+        # Convert user records and id sets of older versions
+        if the_type.startswith("deleted_ids"):
+            convert_windowed_ids(the_data, get_now())
+        elif the_type.startswith("user_ids"):
+            convert_user_ids(the_data)
+
+        # Rollback a shard, or the whole data
+        if ".d/" in the_type:
+            file, shard = the_type.split(".d/")
+            shard = int(shard)
+            data = eval(f"glovar.{file}")
+
+            for key in [key for key in list(data) if get_shard(file, key) == shard]:
+                data.pop(key, None)
+
+            data.update(the_data)
+            save(file)
+        else:
+            exec(f"glovar.{the_type} = the_data")
+            save(the_type)
+
+        # Compile the rules again
+        if the_type.endswith("_words"):
+            with glovar.locks["regex"]:
+                build_rule_set(the_type.split("_")[0])
+                glovar.regex_version += 1
 
         # Send debug message
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
@@ -604,27 +664,63 @@ def receive_rollback(client: Client, message: Message, data: dict) -> bool:
 
 
 def receive_status_ask(client: Client, data: dict) -> bool:
-    # Receive status request
+    # Receive status request, the data is only read or sampled, so the locks are not needed
     result = False
 
-    glovar.locks["white"].acquire()
-    glovar.locks["message"].acquire()
-
     try:
         # Basic data
         aid = data["admin_id"]
         mid = data["message_id"]
 
-        watching_users_count = len([uid for uid in glovar.user_ids if glovar.user_ids[uid].get("message", {})])
+        watching_users_count = get_watching_count()
         waiting_users_count = len(glovar.white_wait_ids)
         white_users_count = len(glovar.white_ids)
+        declared_ids = list(glovar.declared_message_ids.values())
+        declared_hits = sum(ids.hits for ids in declared_ids)
+        declared_lookups = declared_hits + sum(ids.misses for ids in declared_ids)
+        verdict_hits = glovar.ban_verdicts.hits
+        verdict_lookups = verdict_hits + glovar.ban_verdicts.misses
+        name_hits = glovar.name_verdicts.hits
+        name_lookups = name_hits + glovar.name_verdicts.misses
+        rules_evaluated = ", ".join(f"{word_type} {rule_set.get_mean_evaluated():.1f}"
+                                    for word_type, rule_set in list(glovar.rule_sets.items()) if rule_set.matches)
+        regex_time = ", ".join(f"{word_type} {sum(stats[0] for stats in list(profile.values())) * 1000:.1f} ms"
+                               for word_type, profile in list(glovar.regex_profiles.items()) if profile)
+        slow_rules = get_slow_rules()
+        profile_state = lang("enabled") if glovar.regex_profile else lang("disabled")
 
         status = {
             lang("watching_users"): f"{watching_users_count} {lang('members')}",
             lang("waiting_users"): f"{waiting_users_count} {lang('members')}",
-            lang("white_users"): f"{white_users_count} {lang('members')}"
+            lang("white_users"): f"{white_users_count} {lang('members')}",
+            lang("declared_hits"): f"{declared_hits} / {declared_lookups}",
+            lang("verdict_hits"): f"{verdict_hits} / {verdict_lookups}",
+            lang("name_verdict_hits"): f"{name_hits} / {name_lookups}",
+            lang("rules_evaluated"): rules_evaluated or "0",
+            lang("regex_time"): regex_time or profile_state,
+            lang("slow_rules"): "; ".join(f"{word_type} {word} {seconds * 1000:.1f} ms / {calls}"
+                                          for word_type, word, seconds, calls in slow_rules) or profile_state,
+            lang("process_memory"): get_readable_size(get_rss()),
+            lang("save_duration"): f"{glovar.save_status['duration'] * 1000:.1f} ms",
+            lang("backup_duration"): (f"{glovar.backup_status['duration']:.1f} s, "
+                                      f"{get_readable_size(glovar.backup_status['bytes'])}")
         }
 
+        for word_type, word, seconds, calls in slow_rules:
+            logger.warning(f"Slow rule {word_type} {word!r}: {seconds * 1000:.1f} ms in {calls} calls")
+
+        # Entries, memory and the last save time of each data, lazy maps that are not loaded yet are skipped
+        for file in ["declared_message_ids"] + glovar.file_list:
+            file_data = vars(glovar).get(file)
+
+            if file_data is None:
+                continue
+
+            status[file] = f"{len(file_data)} {lang('entries')}, {get_readable_size(get_memory_size(file_data))}"
+
+            if file in glovar.save_times:
+                status[file] += f", {glovar.save_times[file] * 1000:.1f} ms"
+
         file = data_to_file(status)
 
         result = share_data(
@@ -640,9 +736,6 @@ def receive_status_ask(client: Client, data: dict) -> bool:
         )
     except Exception as e:
         logger.warning(f"Receive status ask error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
-        glovar.locks["white"].release()
 
     return result
 
@@ -679,8 +772,8 @@ def receive_user_score(client: Client, project: str, data: dict) -> bool:
             return False
 
         score = data["score"]
-        glovar.user_ids[uid]["score"][project] = score
-        save("user_ids")
+        glovar.user_ids[uid].set_score(project, score)
+        journal("user_ids", ("score", uid, project, score))
 
         if is_high_score_user(uid, False) <= 1.8:
             return True
@@ -18,8 +18,11 @@
 
 import logging
 from copy import deepcopy
+from os import listdir
+from os.path import exists, getsize
 from random import randint
-from time import sleep
+from time import perf_counter, sleep
+from typing import List, Tuple
 
 from PIL import Image
 from pyrogram import Client
@@ -29,37 +32,132 @@ from .. import glovar
 from .channel import send_help, share_data, share_regex_count, share_user_avatar
 from .decorators import retry, threaded
 from .etc import code, delay, general_link, get_now, lang, thread
-from .file import data_to_file, delete_file, get_downloaded_path, save
-from .filters import is_class_d_user, is_high_score_user, is_watch_user
+from .file import bundle_files, data_to_file, delete_file, get_downloaded_path, get_file_hash, journal, merge_hits
+from .file import save
+from .filters import is_class_d_user, is_high_score_user, is_watch_user, quarantine_rule
 from .group import leave_group, save_admins
-from .user import get_user
+from .user import get_message_users, get_new_users, get_user
 from .telegram import get_admins, get_chat_member, get_members, update_online_status
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
+def backup_bundle(client: Client, file_list: List[Tuple[str, str]]) -> Tuple[List[str], int]:
+    # Backup files to BACKUP in one compressed archive, return the shipped files and the archive size
+    result = ([], 0)
+
+    try:
+        file = bundle_files(file_list)
+        size = file and getsize(file)
+
+        for _, path in file_list:
+            path.startswith("tmp/") and delete_file(path)
+
+        if not file:
+            return [], 0
+
+        if not share_data(
+            client=client,
+            receivers=["BACKUP"],
+            action="backup",
+            action_type="bundle",
+            data=[name for name, _ in file_list],
+            file=file
+        ):
+            return [], 0
+
+        result = ([name for name, _ in file_list], size)
+    except Exception as e:
+        logger.warning(f"Backup bundle error: {e}", exc_info=True)
+
+    return result
+
+
+def backup_each(client: Client, file_list: List[Tuple[str, str]]) -> Tuple[List[str], int]:
+    # Backup files to BACKUP one by one, return the shipped files and the total size
+    result = ([], 0)
+
+    try:
+        shipped = []
+        size = 0
+
+        for name, path in file_list:
+            file_size = getsize(path)
+
+            if share_data(
+                client=client,
+                receivers=["BACKUP"],
+                action="backup",
+                action_type="data",
+                data=name,
+                file=path
+            ):
+                shipped.append(name)
+                size += file_size
+
+            sleep(5)
+
+        result = (shipped, size)
+    except Exception as e:
+        logger.warning(f"Backup each error: {e}", exc_info=True)
+
+    return result
+
+
 @threaded()
 def backup_files(client: Client) -> bool:
-    # Backup data files to BACKUP
+    # Backup changed data files to BACKUP
     result = False
 
     try:
+        start = perf_counter()
+        file_list = []
+
         for file in glovar.file_list:
+            # A lazy map not loaded yet has not changed since it was saved, its file is used, so it is not loaded here
+            if file in glovar.lazy_list and file not in vars(glovar):
+                if exists(f"data/{file}"):
+                    file_list.append((file, f"data/{file}"))
+
+                continue
+
             # Check
             if not eval(f"glovar.{file}"):
                 continue
 
-            # Share
-            share_data(
-                client=client,
-                receivers=["BACKUP"],
-                action="backup",
-                action_type="data",
-                data=file,
-                file=f"data/{file}"
-            )
-            sleep(5)
+            # Get the files, data in the database or in id arrays should be pickled first
+            if (glovar.database and file in glovar.database_list) or file in glovar.mapped_files:
+                file_list.append((file, data_to_file(eval(f"glovar.{file}"))))
+            elif file in glovar.shard_list and exists(f"data/{file}.d"):
+                file_list += [(f"{file}.d/{shard}", f"data/{file}.d/{shard}")
+                              for shard in sorted(listdir(f"data/{file}.d")) if not shard.endswith(".tmp")]
+            else:
+                file_list.append((file, f"data/{file}"))
+
+        # Skip the files not changed since the last backup
+        hashes = {name: get_file_hash(path) for name, path in file_list}
+        changed_list = []
+
+        for name, path in file_list:
+            if hashes[name] and hashes[name] == glovar.backup_hashes.get(name):
+                path.startswith("tmp/") and delete_file(path)
+            else:
+                changed_list.append((name, path))
+
+        # Share
+        if glovar.backup_bundle and changed_list:
+            shipped, size = backup_bundle(client, changed_list)
+        else:
+            shipped, size = backup_each(client, changed_list)
+
+        for name in shipped:
+            glovar.backup_hashes[name] = hashes[name]
+
+        glovar.backup_status["bytes"] = size
+        glovar.backup_status["duration"] = perf_counter() - start
+        glovar.backup_status["files"] = len(shipped)
+        glovar.backup_status["skipped"] = len(file_list) - len(changed_list)
 
         result = True
     except Exception as e:
@@ -90,8 +188,10 @@ def interval_min_15(client: Client) -> bool:
         # Basic data
         now = get_now()
 
+        uid_list = get_new_users(now)
+
         with glovar.locks["message"]:
-            user_ids = deepcopy(glovar.user_ids)
+            user_ids = {uid: deepcopy(glovar.user_ids[uid]) for uid in uid_list if glovar.user_ids.get(uid)}
 
         # Check user's avatar
         for uid in user_ids:
@@ -100,7 +200,7 @@ def interval_min_15(client: Client) -> bool:
                 continue
 
             # Check new joined users
-            if not any(now - user_ids[uid]["join"][gid] < glovar.time_new for gid in user_ids[uid]["join"]):
+            if not any(now - user_ids[uid].join[gid] < glovar.time_new for gid in user_ids[uid].join):
                 continue
 
             # Get user
@@ -113,20 +213,20 @@ def interval_min_15(client: Client) -> bool:
             # Get avatar
             file_id = user.photo.big_file_id
             file_ref = ""
-            old_id = user_ids[uid]["avatar"]
+            old_id = user_ids[uid].avatar
 
             if file_id == old_id:
                 continue
 
-            glovar.user_ids[uid]["avatar"] = file_id
-            save("user_ids")
+            glovar.user_ids[uid].avatar = file_id
+            journal("user_ids", ("avatar", uid, file_id))
             image_path = get_downloaded_path(client, file_id, file_ref)
 
             if not image_path:
                 continue
 
-            g_list = list(user_ids[uid]["join"])
-            gid = sorted(g_list, key=lambda g: user_ids[uid]["join"][g], reverse=True)[0]
+            g_list = list(user_ids[uid].join)
+            gid = sorted(g_list, key=lambda g: user_ids[uid].join[g], reverse=True)[0]
 
             with Image.open(image_path) as image:
                 share_user_avatar(client, gid, uid, 0, image)
@@ -140,6 +240,72 @@ def interval_min_15(client: Client) -> bool:
     return result
 
 
+def reorder_rules() -> bool:
+    # Run the rules with more hits for their cost first, the first hit rule is returned, so hot rules end the search
+    result = False
+
+    try:
+        merge_hits()
+
+        for word_type in list(glovar.rule_sets):
+            with glovar.locks["regex"]:
+                rule_set = glovar.rule_sets[word_type]
+                hits = dict(eval(f"glovar.{word_type}_words"))
+
+            if not any(hits.values()):
+                continue
+
+            # Measure the cost outside the lock, the rule set is only replaced if it has not been changed meanwhile
+            slow = []
+            costs = rule_set.measure(glovar.regex_budget, slow)
+
+            # Rules over the budget are quarantined, which builds a new rule set
+            for word, seconds in slow:
+                quarantine_rule(word_type, word, seconds)
+
+            if slow:
+                continue
+
+            ranks = {word: hits.get(word, 0) / max(costs.get(word, 1.0), 1e-9) for word, _ in rule_set.rules}
+            new_rule_set = rule_set.reorder(ranks)
+
+            if new_rule_set.rules == rule_set.rules:
+                continue
+
+            with glovar.locks["regex"]:
+                if glovar.rule_sets.get(word_type) is rule_set:
+                    glovar.rule_sets[word_type] = new_rule_set
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Reorder rules error: {e}", exc_info=True)
+
+    return result
+
+
+def report_rules(client: Client) -> bool:
+    # Report the quarantined rules to the debug channel
+    result = False
+
+    try:
+        with glovar.locks["regex"]:
+            reports = glovar.quarantine_reports
+            glovar.quarantine_reports = []
+
+        for word_type, word, seconds in reports:
+            text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
+                    f"{lang('action')}{lang('colon')}{code(lang('quarantine'))}\n"
+                    f"{lang('rule')}{lang('colon')}{code(f'{word_type} {word}')}\n"
+                    f"{lang('more')}{lang('colon')}{code(f'{seconds * 1000:.1f} ms')}\n")
+            send_help(client, glovar.debug_channel_id, text)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Report rules error: {e}", exc_info=True)
+
+    return result
+
+
 def reset_data(client: Client) -> bool:
     # Reset user data every month
     result = False
@@ -155,7 +321,7 @@ def reset_data(client: Client) -> bool:
         save("deleted_ids")
 
         glovar.user_ids = {}
-        save("user_ids")
+        journal("user_ids", ("clear",))
 
         glovar.watch_ids = {
             "ban": {},
@@ -185,26 +351,29 @@ def reset_data(client: Client) -> bool:
 
 
 def send_count(client: Client) -> bool:
-    # Send regex count to REGEX
+    # Send regex count to REGEX, the counts are taken and reset under the lock, and uploaded after it
     result = False
 
-    glovar.locks["regex"].acquire()
-
     try:
-        for word_type in glovar.regex:
-            share_regex_count(client, word_type)
-            word_list = list(eval(f"glovar.{word_type}_words"))
+        merge_hits()
+        counts = {}
+
+        with glovar.locks["regex"]:
+            for word_type in glovar.regex:
+                words = eval(f"glovar.{word_type}_words")
+                counts[word_type] = dict(words)
 
-            for word in word_list:
-                eval(f"glovar.{word_type}_words")[word] = 0
+                for word in list(words):
+                    words[word] = 0
 
-            save(f"{word_type}_words")
+                save(f"{word_type}_words")
+
+        for word_type in counts:
+            share_regex_count(client, word_type, counts[word_type])
 
         result = True
     except Exception as e:
         logger.warning(f"Send count error: {e}", exc_info=True)
-    finally:
-        glovar.locks["regex"].release()
 
     return result
 
@@ -274,7 +443,8 @@ def white_check(client: Client) -> bool:
 
         # Get white ids
         for uid in list(glovar.white_wait_ids):
-            glovar.user_ids[uid]["message"] = {}
+            glovar.user_ids[uid].clear_message()
+            journal("user_ids", ("message_clear", uid))
             gids = glovar.white_wait_ids.pop(uid, set())
 
             if is_class_d_user(uid):
@@ -283,7 +453,7 @@ def white_check(client: Client) -> bool:
             if is_high_score_user(uid, False) > 1.2:
                 continue
 
-            if any(glovar.user_ids[uid]["score"][project] for project in ["noflood", "warn"]):
+            if any(glovar.user_ids[uid].get_score(project) for project in ["noflood", "warn"]):
                 continue
 
             if is_watch_user(uid, "delete", now) or is_watch_user(uid, "ban", now):
@@ -298,8 +468,7 @@ def white_check(client: Client) -> bool:
 
             glovar.white_ids.add(uid)
 
-        save("user_ids")
-        glovar.white_ids = glovar.white_ids | {uid for gid in list(glovar.trust_ids) for uid in glovar.trust_ids[gid]}
+        glovar.white_ids.update({uid for gid in list(glovar.trust_ids) for uid in glovar.trust_ids[gid]})
         save("white_ids")
         glovar.white_wait_ids = {}
         save("white_wait_ids")
@@ -315,13 +484,19 @@ def white_check(client: Client) -> bool:
         )
 
         # Get white wait ids
+        uid_list = get_message_users()
+
         with glovar.locks["message"]:
-            user_ids = deepcopy(glovar.user_ids)
+            user_ids = {uid: deepcopy(glovar.user_ids[uid]) for uid in uid_list if glovar.user_ids.get(uid)}
+
+            # Drop the deleted message ids out of the window
+            for gid in list(glovar.deleted_ids):
+                if glovar.deleted_ids[gid].prune(now - glovar.time_deleted):
+                    save("deleted_ids", gid)
 
         for gid in list(glovar.admin_ids):
             white_wait(client, gid, user_ids, now)
 
-        save("user_ids")
         save("white_wait_ids")
 
         result = True
@@ -344,7 +519,7 @@ def white_wait(client: Client, gid: int, user_ids: dict, now: int) -> bool:
         if not members:
             return False
 
-        valid_members = filter(lambda m: m and m.user and user_ids.get(m.user.id, {}), members)
+        valid_members = filter(lambda m: m and m.user and user_ids.get(m.user.id), members)
 
         for member in valid_members:
             if member.status != "member":
@@ -362,7 +537,7 @@ def white_wait(client: Client, gid: int, user_ids: dict, now: int) -> bool:
             if is_high_score_user(uid, False) > 1.2:
                 continue
 
-            if any(glovar.user_ids[uid]["score"][project] for project in ["noflood", "warn"]):
+            if any(glovar.user_ids[uid].get_score(project) for project in ["noflood", "warn"]):
                 continue
 
             if is_watch_user(uid, "delete", now) or is_watch_user(uid, "ban", now):
@@ -374,14 +549,13 @@ def white_wait(client: Client, gid: int, user_ids: dict, now: int) -> bool:
             if glovar.white_wait_ids.get(uid, set()):
                 continue
 
-            if not any(len(messages) > glovar.limit_message
-                       for messages in [{mid for mid in user_ids[uid]["message"][group_id]
-                                         if mid not in glovar.deleted_ids[group_id]}
-                                        for group_id in list(user_ids[uid]["message"])]):
+            if not any(glovar.deleted_ids[group_id].count_absent(user_ids[uid].message[group_id]) > glovar.limit_message
+                       for group_id in list(user_ids[uid].message)):
                 continue
 
-            glovar.user_ids[uid]["message"] = {}
-            glovar.white_wait_ids[uid] = set(user_ids[uid]["message"])
+            glovar.user_ids[uid].clear_message()
+            journal("user_ids", ("message_clear", uid))
+            glovar.white_wait_ids[uid] = set(user_ids[uid].message)
 
         result = True
     except FloodWait as e:
@@ -17,17 +17,59 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from typing import Optional, Union
+from typing import Optional, Set, Union
 
 from pyrogram import Client, User
 
 from .. import glovar
+from ..storage import query_message_users, query_new_users, query_watching_count
+from .file import flush_database, journal
 from .telegram import get_users
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
+def get_message_users() -> Set[int]:
+    # Get users who have sent enough messages in a group
+    result = set()
+
+    try:
+        if glovar.database:
+            flush_database("user_ids")
+
+            with glovar.locks["database"]:
+                return query_message_users(glovar.database, glovar.limit_message)
+
+        result = {uid for uid in list(glovar.user_ids)
+                  if any(len(mids) > glovar.limit_message for mids in list(glovar.user_ids[uid].message.values()))}
+    except Exception as e:
+        logger.warning(f"Get message users error: {e}", exc_info=True)
+
+    return result
+
+
+def get_new_users(now: int) -> Set[int]:
+    # Get users who joined a group recently
+    result = set()
+
+    try:
+        since = now - glovar.time_new
+
+        if glovar.database:
+            flush_database("user_ids")
+
+            with glovar.locks["database"]:
+                return query_new_users(glovar.database, since)
+
+        result = {uid for uid in list(glovar.user_ids)
+                  if any(joined > since for joined in list(glovar.user_ids[uid].join.values()))}
+    except Exception as e:
+        logger.warning(f"Get new users error: {e}", exc_info=True)
+
+    return result
+
+
 def get_user(client: Client, uid: Union[int, str]) -> Optional[User]:
     # Get a user
     result = None
@@ -45,13 +87,33 @@ def get_user(client: Client, uid: Union[int, str]) -> Optional[User]:
     return result
 
 
+def get_watching_count() -> int:
+    # Get the count of users who have message records
+    result = 0
+
+    try:
+        if glovar.database:
+            flush_database("user_ids")
+
+            with glovar.locks["database"]:
+                return query_watching_count(glovar.database)
+
+        result = len([uid for uid in list(glovar.user_ids) if glovar.user_ids[uid].message])
+    except Exception as e:
+        logger.warning(f"Get watching count error: {e}", exc_info=True)
+
+    return result
+
+
 def remove_new_users() -> bool:
     # Remove new users
     result = False
 
     try:
         for uid in list(glovar.user_ids):
-            glovar.user_ids[uid]["join"] = {}
+            glovar.user_ids[uid].clear_join()
+
+        journal("user_ids", ("join_clear",))
 
         result = True
     except Exception as e:
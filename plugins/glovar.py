@@ -17,20 +17,27 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import pickle
 from codecs import getdecoder
+from concurrent.futures import ProcessPoolExecutor
 from configparser import RawConfigParser
-from os import mkdir
+from os import mkdir, remove
 from os.path import exists
 from shutil import rmtree
+from sqlite3 import Connection
 from string import ascii_lowercase
 from threading import Lock
-from typing import Dict, List, Set, Union
+from time import perf_counter, time
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
 from emoji import UNICODE_EMOJI
 from yaml import safe_load
 
 from .checker import check_all
+from .rules import CategoryMatcher, RuleSet
+from .storage import apply_user_record, connect_database, load_data, read_ids, read_journal, read_users, read_waits
+from .storage import read_watches, write_users, write_waits, write_watches
+from .structures import HitCounter, RecentIds, UserStatus, VerdictCache, WindowedIds, convert_user_ids
+from .structures import convert_windowed_ids
 
 # Enable logging
 logging.basicConfig(
@@ -68,6 +75,13 @@ hide_channel_id: int = 0
 project_link: str = "https://scp-079.org/avatar/"
 project_name: str = "SCP-079-AVATAR"
 
+# [data]
+backend: str = "pickle"
+backup_bundle: Union[bool, str] = "False"
+journal_size: int = 8388608
+mmap_ids: Union[bool, str] = "False"
+shards: int = 16
+
 # [emoji]
 emoji_ad_single: int = 15
 emoji_ad_total: int = 30
@@ -85,20 +99,36 @@ lang: str = "cmn-Hans"
 normalize: Union[bool, str] = "True"
 
 # [limit]
+limit_declared: int = 1000
 limit_length: int = 30
 limit_message: int = 50
+limit_offload: int = 500
+limit_verdict: int = 10000
 
 # [mode]
 aio: Union[bool, str] = "False"
 backup: Union[bool, str] = "False"
 
+# [regex]
+regex_budget: float = 0.0
+regex_combine: Union[bool, str] = "False"
+regex_prefilter: Union[bool, str] = "True"
+regex_profile: Union[bool, str] = "False"
+regex_reorder: Union[bool, str] = "True"
+regex_workers: int = 0
+
 # [time]
 date_reset: str = "1st mon"
 time_begin: int = 0
 time_check: int = 5
+time_declared: int = 86400
+time_deleted: int = 3024000
 time_end: int = 12
 time_new: int = 1800
+time_offload: int = 5
 time_old: int = 7776000
+time_save: int = 5
+time_verdict: int = 3600
 
 try:
     config = RawConfigParser()
@@ -126,6 +156,15 @@ try:
     project_link = config.get("custom", "project_link", fallback=project_link)
     project_name = config.get("custom", "project_name", fallback=project_name)
 
+    # [data]
+    backend = config.get("data", "backend", fallback=backend)
+    backup_bundle = config.get("data", "backup_bundle", fallback=backup_bundle)
+    backup_bundle = eval(backup_bundle)
+    journal_size = int(config.get("data", "journal_size", fallback=journal_size))
+    mmap_ids = config.get("data", "mmap_ids", fallback=mmap_ids)
+    mmap_ids = eval(mmap_ids)
+    shards = int(config.get("data", "shards", fallback=shards))
+
     # [emoji]
     emoji_ad_single = int(config.get("emoji", "emoji_ad_single", fallback=emoji_ad_single))
     emoji_ad_total = int(config.get("emoji", "emoji_ad_total", fallback=emoji_ad_total))
@@ -146,8 +185,11 @@ try:
     normalize = eval(normalize)
 
     # [limit]
+    limit_declared = int(config.get("limit", "limit_declared", fallback=limit_declared))
     limit_length = int(config.get("limit", "limit_length", fallback=limit_length))
     limit_message = int(config.get("limit", "limit_message", fallback=limit_message))
+    limit_offload = int(config.get("limit", "limit_offload", fallback=limit_offload))
+    limit_verdict = int(config.get("limit", "limit_verdict", fallback=limit_verdict))
 
     # [mode]
     aio = config.get("mode", "aio", fallback=aio)
@@ -155,13 +197,30 @@ try:
     backup = config.get("mode", "backup", fallback=backup)
     backup = eval(backup)
 
+    # [regex]
+    regex_budget = float(config.get("regex", "regex_budget", fallback=regex_budget))
+    regex_combine = config.get("regex", "regex_combine", fallback=regex_combine)
+    regex_combine = eval(regex_combine)
+    regex_prefilter = config.get("regex", "regex_prefilter", fallback=regex_prefilter)
+    regex_prefilter = eval(regex_prefilter)
+    regex_profile = config.get("regex", "regex_profile", fallback=regex_profile)
+    regex_profile = eval(regex_profile)
+    regex_reorder = config.get("regex", "regex_reorder", fallback=regex_reorder)
+    regex_reorder = eval(regex_reorder)
+    regex_workers = int(config.get("regex", "regex_workers", fallback=regex_workers))
+
     # [time]
     date_reset = config.get("time", "date_reset", fallback=date_reset)
     time_begin = int(config.get("time", "time_begin", fallback=time_begin))
     time_check = int(config.get("time", "time_check", fallback=time_check))
+    time_declared = int(config.get("time", "time_declared", fallback=time_declared))
+    time_deleted = int(config.get("time", "time_deleted", fallback=time_deleted))
     time_end = int(config.get("time", "time_end", fallback=time_end))
     time_new = int(config.get("time", "time_new", fallback=time_new))
+    time_offload = int(config.get("time", "time_offload", fallback=time_offload))
     time_old = int(config.get("time", "time_old", fallback=time_old))
+    time_save = int(config.get("time", "time_save", fallback=time_save))
+    time_verdict = int(config.get("time", "time_verdict", fallback=time_verdict))
 
     # [flag]
     broken = False
@@ -194,6 +253,13 @@ check_all(
             "project_link": project_link,
             "project_name": project_name
         },
+        "data": {
+            "backend": backend,
+            "backup_bundle": backup_bundle,
+            "journal_size": journal_size,
+            "mmap_ids": mmap_ids,
+            "shards": shards
+        },
         "emoji": {
             "emoji_ad_single": emoji_ad_single,
             "emoji_ad_total": emoji_ad_total,
@@ -211,19 +277,35 @@ check_all(
             "normalize": normalize
         },
         "limit": {
+            "limit_declared": limit_declared,
             "limit_length": limit_length,
-            "limit_message": limit_message
+            "limit_message": limit_message,
+            "limit_offload": limit_offload,
+            "limit_verdict": limit_verdict
         },
         "mode": {
             "aio": aio,
             "backup": backup
         },
+        "regex": {
+            "regex_budget": regex_budget,
+            "regex_combine": regex_combine,
+            "regex_prefilter": regex_prefilter,
+            "regex_profile": regex_profile,
+            "regex_reorder": regex_reorder,
+            "regex_workers": regex_workers
+        },
         "time": {
             "date_reset": date_reset,
             "time_begin": time_begin,
             "time_check": time_check,
+            "time_declared": time_declared,
+            "time_deleted": time_deleted,
             "time_new": time_new,
-            "time_old": time_old
+            "time_offload": time_offload,
+            "time_old": time_old,
+            "time_save": time_save,
+            "time_verdict": time_verdict
         }
     },
     broken
@@ -244,34 +326,53 @@ except Exception as e:
 bot_ids: Set[int] = {avatar_id, captcha_id, clean_id, index_id, lang_id, long_id,
                      noflood_id, noporn_id, nospam_id, tip_id, user_id, warn_id}
 
-declared_message_ids: Dict[int, Set[int]] = {}
+declared_message_ids: Dict[int, RecentIds] = {}
 # declared_message_ids = {
-#     -10012345678: {123}
+#     -10012345678: RecentIds([123], capacity=1000, ttl=86400)
+# }
+
+backup_hashes: Dict[str, str] = {}
+# backup_hashes = {
+#     "user_ids.d/3": "0123456789abcdef"
 # }
 
-default_user_status: Dict[str, Union[str, Dict[int, int]]] = {
-    "avatar": "",
-    "join": {},
-    "message": {},
-    "score": {
-        "captcha": 0.0,
-        "clean": 0.0,
-        "lang": 0.0,
-        "long": 0.0,
-        "noflood": 0.0,
-        "noporn": 0.0,
-        "nospam": 0.0,
-        "warn": 0.0
-    }
+backup_status: Dict[str, Union[float, int]] = {
+    "bytes": 0,
+    "duration": 0.0,
+    "files": 0,
+    "skipped": 0
 }
 
+dirty_files: Set[str] = set()
+# dirty_files = {"user_ids"}
+
+dirty_shards: Dict[str, Set[int]] = {}
+# dirty_shards = {
+#     "deleted_ids": {-10012345678}
+# }
+
 emoji_set: Set[str] = set(UNICODE_EMOJI)
 
+journal_records: Dict[str, List[tuple]] = {}
+# journal_records = {
+#     "user_ids": [("message", 12345678, -10012345678, 123)]
+# }
+
+journal_shards: Dict[str, Set[int]] = {}
+# journal_shards = {
+#     "user_ids": {3}
+# }
+
 locks: Dict[str, Lock] = {
     "admin": Lock(),
+    "database": Lock(),
+    "flush": Lock(),
+    "load": Lock(),
     "message": Lock(),
+    "pool": Lock(),
     "receive": Lock(),
     "regex": Lock(),
+    "save": Lock(),
     "white": Lock()
 }
 
@@ -295,8 +396,61 @@ regex: Dict[str, bool] = {
 for c in ascii_lowercase:
     regex[f"ad{c}"] = False
 
+ad_matcher: Optional[CategoryMatcher] = None
+
+ban_verdicts: VerdictCache = VerdictCache(limit_verdict, time_verdict)
+# ban_verdicts = {
+#     (0, False, b"text hash"): (True, (("ban", "regex"),))
+# }
+
+name_verdicts: VerdictCache = VerdictCache(limit_verdict, time_verdict)
+# name_verdicts = {
+#     (0, 12345678, b"name hash"): (False, ())
+# }
+
+regex_hits: HitCounter = HitCounter()
+
+regex_profiles: Dict[str, Dict[str, list]] = {}
+# regex_profiles = {
+#     "ban": {
+#         "regex": [0.5, 1000]
+#     }
+# }
+
+regex_version: int = 0
+
+quarantined_rules: Dict[str, Set[str]] = {}
+# quarantined_rules = {
+#     "ban": {"regex"}
+# }
+
+quarantine_reports: List[Tuple[str, str, float]] = []
+# quarantine_reports = [("ban", "regex", 0.5)]
+
+rule_sets: Dict[str, RuleSet] = {}
+# rule_sets = {
+#     "ban": RuleSet(["regex"])
+# }
+
+save_status: Dict[str, Union[float, int]] = {
+    "bytes": 0,
+    "coalesced": 0,
+    "duration": 0.0,
+    "flushes": 0,
+    "saves": 0
+}
+
+save_times: Dict[str, float] = {}
+# save_times = {
+#     "user_ids": 0.01
+# }
+
 sender: str = "AVATAR"
 
+text_pool: Optional[ProcessPoolExecutor] = None
+
+text_pool_version: int = -1
+
 version: str = "0.2.8"
 
 # Load data from pickle
@@ -326,9 +480,11 @@ bad_ids: Dict[str, Set[int]] = {
 #     "users": {12345678}
 # }
 
-deleted_ids: Dict[int, Set[int]] = {}
+deleted_ids: Dict[int, WindowedIds] = {}
 # deleted_ids = {
-#     -10012345678: {123}
+#     -10012345678: WindowedIds({
+#         18000: IntSet([123])
+#     })
 # }
 
 except_ids: Dict[str, Set[str]] = {
@@ -349,17 +505,17 @@ trust_ids: Dict[int, Set[int]] = {}
 #     -10012345678: {12345678}
 # }
 
-user_ids: Dict[int, Dict[str, Union[str, Dict[Union[int, str], Union[float, int, Set[int]]]]]] = {}
+user_ids: Dict[int, UserStatus] = {}
 # user_ids = {
-#     12345678: {
-#         "avatar": "",
-#         "join": {
+#     12345678: UserStatus(
+#         avatar="",
+#         join={
 #             -10012345678: 1512345678
 #         },
-#         "message": {
-#             -10012345678: {123}
+#         message={
+#             -10012345678: IntSet([123])
 #         },
-#         "score": {
+#         score={
 #             "captcha": 0.0,
 #             "clean": 0.0,
 #             "lang": 0.0,
@@ -369,7 +525,7 @@ user_ids: Dict[int, Dict[str, Union[str, Dict[Union[int, str], Union[float, int,
 #             "nospam": 0.0,
 #             "warn": 0.0
 #         }
-#     }
+#     )
 # }
 
 watch_ids: Dict[str, Dict[int, int]] = {
@@ -398,8 +554,14 @@ white_wait_ids: Dict[int, Set[int]] = {}
 
 # Init word variables
 
+# Rarely used word maps are loaded on first access, see __getattr__
+lazy_list: List[str] = [f"ad{c}_words" for c in ascii_lowercase]
+
 for word_type in regex:
-    locals()[f"{word_type}_words"]: Dict[str, Dict[str, Union[float, int]]] = {}
+    if f"{word_type}_words" in lazy_list:
+        continue
+
+    globals()[f"{word_type}_words"]: Dict[str, Dict[str, Union[float, int]]] = {}
 
 # type_words = {
 #     "regex": 0
@@ -410,29 +572,133 @@ file_list: List[str] = ["admin_ids", "bad_ids", "deleted_ids", "except_ids", "fl
                         "trust_ids", "user_ids", "watch_ids", "white_ids", "white_kicked_ids", "white_wait_ids"]
 file_list += [f"{f}_words" for f in regex]
 
-for file in file_list:
+# Large maps are split into shards, user_ids by the hash of the user's ID, deleted_ids by group
+shard_list: List[str] = ["deleted_ids", "user_ids"]
+
+# Maps kept in the database when the SQLite backend is used
+database: Optional[Connection] = None
+database_list: List[str] = ["user_ids", "watch_ids", "white_wait_ids"]
+migrate: bool = backend == "sqlite" and not exists("data/database.db")
+
+# Large id sets, kept in sorted arrays which are memory-mapped when the mmap_ids option is enabled
+array_list: List[str] = ["bad_ids.users", "white_ids", "white_kicked_ids"]
+mapped_list: List[str] = array_list if mmap_ids else []
+mapped_files: Set[str] = {name.split(".")[0] for name in mapped_list}
+
+load_list: List[str] = [file for file in file_list
+                        if file not in lazy_list and (backend != "sqlite" or migrate or file not in database_list)
+                        and (file not in mapped_list or not exists(f"data/{file}.ids"))]
+load_start: float = perf_counter()
+load_times: Dict[str, float] = {}
+
+try:
+    # Unpickling holds the GIL, so the files are loaded one by one
+    for file in load_list:
+        data, dirty, duration = load_data(file, globals()[file], file in shard_list,
+                                          0 if file == "deleted_ids" else shards)
+        globals()[file] = data
+        dirty and dirty_files.add(file)
+        load_times[file] = duration
+except Exception as e:
+    logger.critical(f"Load data error: {e}", exc_info=True)
+    raise SystemExit("[DATA CORRUPTION]")
+
+# Map the id arrays, convert between arrays and sets on the next save if the mmap_ids option was changed
+for name in array_list:
+    file, _, key = name.partition(".")
+
+    try:
+        if not exists(f"data/{name}.ids"):
+            mmap_ids and dirty_files.add(file)
+            continue
+
+        ids = read_ids(f"data/{name}.ids")
+
+        if not mmap_ids:
+            ids = set(ids)
+            dirty_files.add(file)
+
+        if key:
+            globals()[file][key] = ids
+        else:
+            globals()[file] = ids
+    except Exception as e:
+        logger.critical(f"Map data {name} error: {e}", exc_info=True)
+        raise SystemExit("[DATA CORRUPTION]")
+
+# Convert user records and id sets of older versions
+if "deleted_ids" in load_list and convert_windowed_ids(deleted_ids, int(time())):
+    dirty_files.add("deleted_ids")
+
+if "user_ids" in load_list and convert_user_ids(user_ids):
+    dirty_files.add("user_ids")
+
+# Replay journals
+journal_list: List[str] = ["user_ids"]
+
+for file in journal_list:
+    if file not in load_list:
+        continue
+
+    try:
+        for record in read_journal(f"data/{file}.journal"):
+            apply_user_record(globals()[file], record)
+            dirty_files.add(file)
+    except Exception as e:
+        logger.critical(f"Replay journal {file} error: {e}", exc_info=True)
+        raise SystemExit("[DATA CORRUPTION]")
+
+# Load data from database
+if backend == "sqlite":
     try:
-        try:
-            if exists(f"data/{file}") or exists(f"data/.{file}"):
-                with open(f"data/{file}", "rb") as f:
-                    locals()[f"{file}"] = pickle.load(f)
-            else:
-                with open(f"data/{file}", "wb") as f:
-                    pickle.dump(eval(f"{file}"), f)
-        except Exception as e:
-            logger.error(f"Load data {file} error: {e}", exc_info=True)
-
-            with open(f"data/.{file}", "rb") as f:
-                locals()[f"{file}"] = pickle.load(f)
+        start = perf_counter()
+        database = connect_database("data/database.db")
+
+        if migrate:
+            # Import the pickled data into a new database
+            if not (write_users(database, user_ids)
+                    and write_watches(database, watch_ids)
+                    and write_waits(database, white_wait_ids)):
+                raise ValueError("Migration failed")
+        else:
+            user_ids = read_users(database)
+            watch_ids = read_watches(database)
+            white_wait_ids = read_waits(database)
+
+        load_times["database"] = perf_counter() - start
     except Exception as e:
-        logger.critical(f"Load data {file} backup error: {e}", exc_info=True)
+        logger.critical(f"Load database error: {e}", exc_info=True)
+        migrate and exists("data/database.db") and remove("data/database.db")
         raise SystemExit("[DATA CORRUPTION]")
 
+
+def __getattr__(name: str) -> Any:
+    # Load a lazy data file on first access
+    if name not in lazy_list:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    with locks["load"]:
+        if name not in globals():
+            data, _, duration = load_data(name, {}, False)
+            globals()[name] = data
+            load_times[name] = duration
+
+    return globals()[name]
+
+
+# Compile the rules of loaded word maps, rules of lazy word maps are compiled on first use
+for word_type in regex:
+    if f"{word_type}_words" in lazy_list:
+        continue
+
+    rule_sets[word_type] = RuleSet(globals()[f"{word_type}_words"], regex_combine, regex_prefilter,
+                                   bool(regex_budget))
+
 # Generate special characters dictionary
 for special in ["spc", "spe"]:
-    locals()[f"{special}_dict"]: Dict[str, str] = {}
+    globals()[f"{special}_dict"] = {}
 
-    for rule in locals()[f"{special}_words"]:
+    for rule in globals()[f"{special}_words"]:
         # Check keys
         if "[" not in rule:
             continue
@@ -445,9 +711,14 @@ for special in ["spc", "spe"]:
         value = rule.split("?#")[1][1]
 
         for k in keys:
-            locals()[f"{special}_dict"][k] = value
+            globals()[f"{special}_dict"][k] = value
 
 # Start program
 copyright_text = (f"SCP-079-{sender} v{version}, Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>\n"
                   "Licensed under the terms of the GNU General Public License v3 or later (GPLv3+)\n")
 print(copyright_text)
+
+# Startup timing report
+load_text = "".join(f"{file}: {load_times[file]:.3f}s\n"
+                    for file in sorted(load_times, key=load_times.get, reverse=True))
+print(f"Data loaded in {perf_counter() - load_start:.3f}s\n{load_text}")
@@ -25,15 +25,16 @@ from typing import List
 
 from .. import glovar
 from ..functions.channel import share_user_avatar
-from ..functions.etc import get_hour, get_full_name, get_now, get_text, thread
-from ..functions.file import delete_file, get_downloaded_path, save
+from ..functions.etc import get_hour, get_now, get_text, thread
+from ..functions.file import delete_file, get_downloaded_path, journal, save
 from ..functions.filters import aio, authorized_group, class_d, declared_message, detect_nospam, from_user
 from ..functions.filters import hide_channel, is_ban_text, is_class_d_user, is_declared_message, is_high_score_user
-from ..functions.filters import is_nm_text, is_watch_user, is_valid_character, white_user
+from ..functions.filters import is_nm_user, is_watch_user, is_valid_character, white_user
 from ..functions.ids import init_group_id, init_user_id
 from ..functions.receive import receive_add_bad, receive_add_except, receive_captcha_flood, receive_captcha_kicked_user
 from ..functions.receive import receive_captcha_kicked_users, receive_clear_data, receive_declared_message
-from ..functions.receive import receive_flood_score, receive_refresh, receive_regex, receive_remove_bad
+from ..functions.receive import receive_flood_score, receive_profile, receive_refresh, receive_regex
+from ..functions.receive import receive_remove_bad
 from ..functions.receive import receive_remove_except, receive_remove_score, receive_remove_white, receive_rollback
 from ..functions.receive import receive_status_ask, receive_text_data, receive_user_score, receive_version_ask
 from ..functions.receive import receive_warn_kicked_user, receive_watch_user
@@ -49,11 +50,11 @@ logger = logging.getLogger(__name__)
                    & from_user & ~class_d & ~white_user
                    & ~declared_message)
 def check(_: Client, message: Message) -> bool:
-    # Check message sent from users
+    # Check message sent from users, the status is checked and the message id is recorded under the lock,
+    # the name and the text are checked without it, the rule sets are published lock-free,
+    # so handler threads can classify long texts in the process pool at the same time
     result = False
 
-    glovar.locks["message"].acquire()
-
     try:
         # Basic data
         gid = message.chat.id
@@ -62,30 +63,31 @@ def check(_: Client, message: Message) -> bool:
         hour = get_hour()
         now = message.date or get_now()
 
-        # Check group status
-        if gid in glovar.flooded_ids:
-            return False
+        with glovar.locks["message"]:
+            # Check group status
+            if gid in glovar.flooded_ids:
+                return False
 
-        # Check hour
-        if (hour < glovar.time_begin < glovar.time_end
-                or glovar.time_begin < glovar.time_end < hour
-                or glovar.time_end < hour < glovar.time_begin):
-            return False
+            # Check hour
+            if (hour < glovar.time_begin < glovar.time_end
+                    or glovar.time_begin < glovar.time_end < hour
+                    or glovar.time_end < hour < glovar.time_begin):
+                return False
 
-        # Check white wait status
-        if glovar.white_wait_ids.get(uid, set()):
-            return False
+            # Check white wait status
+            if glovar.white_wait_ids.get(uid, set()):
+                return False
 
-        # Check watch status
-        if is_watch_user(message.from_user, "ban", now) or is_watch_user(message.from_user, "delete", now):
-            return False
+            # Check watch status
+            if is_watch_user(message.from_user, "ban", now) or is_watch_user(message.from_user, "delete", now):
+                return False
 
-        # Check score
-        if is_high_score_user(message.from_user, False) > 1.2:
-            return False
+            # Check score
+            if is_high_score_user(message.from_user, False) > 1.2:
+                return False
 
         # Check name
-        if is_nm_text(get_full_name(message.from_user, True, True, True)):
+        if is_nm_user(message.from_user):
             return False
 
         # Check message text
@@ -100,22 +102,18 @@ def check(_: Client, message: Message) -> bool:
         if len(message_text) < glovar.limit_length:
             return False
 
-        # Init user id
-        if not init_user_id(uid):
-            return False
-
-        # Record message id
-        if not glovar.user_ids[uid]["message"].get(gid, set()):
-            glovar.user_ids[uid]["message"][gid] = set()
+        with glovar.locks["message"]:
+            # Init user id
+            if not init_user_id(uid):
+                return False
 
-        glovar.user_ids[uid]["message"][gid].add(mid)
-        save("user_ids")
+            # Record message id
+            glovar.user_ids[uid].add_message(gid, mid)
+            journal("user_ids", ("message", uid, gid, mid))
 
         result = True
     except Exception as e:
         logger.warning(f"Check error: {e}", exc_info=True)
-    finally:
-        glovar.locks["message"].release()
 
     return result
 
@@ -169,9 +167,9 @@ def check_join(client: Client, message: Message) -> bool:
                 continue
 
             # Update user's join status
-            joined = glovar.user_ids[uid]["join"].get(gid)
-            glovar.user_ids[uid]["join"][gid] = now
-            save("user_ids")
+            joined = glovar.user_ids[uid].join.get(gid)
+            glovar.user_ids[uid].set_join(gid, now)
+            journal("user_ids", ("join", uid, gid, now))
 
             # Check group status
             if glovar.nospam_id not in glovar.admin_ids[gid]:
@@ -183,13 +181,13 @@ def check_join(client: Client, message: Message) -> bool:
 
             file_id = new.photo.big_file_id
             file_ref = ""
-            old_id = glovar.user_ids[uid]["avatar"]
+            old_id = glovar.user_ids[uid].avatar
 
             if file_id == old_id and joined:
                 continue
 
-            glovar.user_ids[uid]["avatar"] = file_id
-            save("user_ids")
+            glovar.user_ids[uid].avatar = file_id
+            journal("user_ids", ("avatar", uid, file_id))
             image_path = get_downloaded_path(client, file_id, file_ref)
 
             if not image_path:
@@ -372,7 +370,9 @@ def process_data(client: Client, message: Message) -> bool:
                         receive_status_ask(client, data)
 
                 elif action == "update":
-                    if action_type == "refresh":
+                    if action_type == "profile":
+                        receive_profile(client, data)
+                    elif action_type == "refresh":
                         receive_refresh(client, data)
 
             elif sender == "NOFLOOD":
@@ -467,6 +467,7 @@ def deleted(_: Client, messages: List[Message]) -> bool:
 
     try:
         group_list = set(glovar.admin_ids)
+        now = get_now()
 
         for message in messages:
             if not message.chat:
@@ -484,9 +485,9 @@ def deleted(_: Client, messages: List[Message]) -> bool:
             if not init_group_id(gid):
                 continue
 
-            glovar.deleted_ids[gid].add(mid)
-
-        save("deleted_ids")
+            glovar.deleted_ids[gid].add(mid, now)
+            glovar.deleted_ids[gid].prune(now - glovar.time_deleted)
+            save("deleted_ids", gid)
 
         result = True
     except Exception as e:
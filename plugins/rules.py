@@ -0,0 +1,494 @@
+# SCP-079-AVATAR - Get newly joined member's profile photo
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-AVATAR.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import re
+from collections import deque
+from copy import copy
+from time import thread_time
+from typing import Dict, FrozenSet, Iterable, List, Match, Optional, Pattern, Tuple
+
+import regex
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+# Flags used by every rule
+rule_flags = re.I | re.S | re.M
+
+# Type of the patterns compiled by re, which do not take a timeout
+re_pattern_type = type(re.compile(""))
+
+# Characters the regex engine matches case-insensitively but str.casefold() does not fold together
+fold_table = {ord("İ"): "i", ord("ı"): "i"}
+
+# Items of these types match an empty string, so a literal run goes on across them
+zero_width_ops = {sre_parse.ASSERT, sre_parse.ASSERT_NOT, sre_parse.AT}
+
+# Repeat operators
+repeat_ops = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", sre_parse.MAX_REPEAT)}
+
+# Rules with backreferences, named groups, conditions or global flags can not be put in one alternation
+uncombinable_pattern = re.compile(r"\\[1-9]|\(\?P[<=]|\(\?\(|\(\?[aiLmsux]+\)")
+
+
+class CategoryMatcher:
+    # Rules of several word types that are checked together, such as the ad categories,
+    # a text is scanned once for the literals of all rules, then only the possible rules of each category are run
+    __slots__ = ("categories", "literal_filter", "order", "rule_sets")
+
+    def __init__(self, rule_sets: Dict[str, "RuleSet"], prefilter: bool = False):
+        self.categories: Tuple[str, ...] = tuple(rule_sets)
+        self.literal_filter: Optional[LiteralFilter] = None
+        self.order: Dict[Tuple[str, str], Tuple[int, Pattern]] = {}
+        self.rule_sets: Tuple["RuleSet", ...] = tuple(rule_sets.values())
+
+        for category, rule_set in rule_sets.items():
+            for word, pattern in rule_set.rules:
+                self.order[(category, word)] = (len(self.order), pattern)
+
+        if prefilter:
+            self.literal_filter = LiteralFilter({key: get_literals(key[1]) for key in self.order})
+
+    def __repr__(self) -> str:
+        return f"CategoryMatcher({len(self.categories)} categories, {len(self.order)} rules)"
+
+    def search(self, text: str, stripped: str = "", ocr: bool = False, limit: int = 0,
+               profiles: Dict[str, Dict[str, list]] = None, budget: float = 0.0,
+               slow: List[Tuple[str, str, float]] = None) -> Dict[str, Tuple[str, Match]]:
+        # Return the first hit rule of each hit category, in category order, until the limit is reached,
+        # the stripped text is tried for a category only if the text does not hit it,
+        # with the profiles of categories given, the time of each rule is added to them,
+        # rules that run over the budget are added to the slow list with their categories
+        result = {}
+        keys = self.literal_filter.scan(text) if self.literal_filter is not None else self.order
+        rules = {}
+
+        for key in sorted(keys, key=lambda k: self.order[k][0]):
+            category, word = key
+
+            if ocr and "(?# nocr)" in word:
+                continue
+
+            rules.setdefault(category, []).append((word, self.order[key][1]))
+
+        for category, rule_set in zip(self.categories, self.rule_sets):
+            if category not in rules:
+                continue
+
+            profile = profiles and profiles.get(category)
+            slow_rules = []
+            hit, evaluated = RuleSet.search_rules(text, rules[category], profile, budget, slow_rules)
+            rule_set.record(text, evaluated, hit)
+
+            if not hit and stripped:
+                hit, evaluated = RuleSet.search_rules(stripped, rules[category], profile, budget, slow_rules)
+                rule_set.record(stripped, evaluated, hit)
+
+            if slow_rules and slow is not None:
+                slow += [(category, word, seconds) for word, seconds in slow_rules]
+
+            if not hit:
+                continue
+
+            result[category] = hit
+
+            if limit and len(result) >= limit:
+                break
+
+        return result
+
+
+class LiteralFilter:
+    # An Aho-Corasick automaton of the literals required by the rules, a text is scanned once to find the rules
+    # that may match it, rules without any required literal are always returned
+    __slots__ = ("always", "fail", "goto", "output")
+
+    def __init__(self, literals: Dict[str, Optional[FrozenSet[str]]]):
+        always = set()
+        goto: List[Dict[str, int]] = [{}]
+        output: List[set] = [set()]
+
+        for word, strings in literals.items():
+            if not strings:
+                always.add(word)
+                continue
+
+            for string in strings:
+                state = 0
+
+                for char in string:
+                    following = goto[state].get(char)
+
+                    if following is None:
+                        following = goto[state][char] = len(goto)
+                        goto.append({})
+                        output.append(set())
+
+                    state = following
+
+                output[state].add(word)
+
+        # Link each state to the longest proper suffix that is also a state, breadth first
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+
+        while queue:
+            state = queue.popleft()
+
+            for char, following in goto[state].items():
+                queue.append(following)
+                suffix = fail[state]
+
+                while suffix and char not in goto[suffix]:
+                    suffix = fail[suffix]
+
+                fail[following] = goto[suffix].get(char, 0)
+                output[following] |= output[fail[following]]
+
+        self.always: FrozenSet[str] = frozenset(always)
+        self.fail: List[int] = fail
+        self.goto: List[Dict[str, int]] = goto
+        self.output: List[Optional[FrozenSet[str]]] = [frozenset(words) if words else None for words in output]
+
+    def __len__(self) -> int:
+        return len(self.goto)
+
+    def scan(self, text: str) -> set:
+        # Return the rules whose required literals are found in the text
+        result = set(self.always)
+        fail = self.fail
+        goto = self.goto
+        output = self.output
+        state = 0
+
+        for char in fold_text(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+
+            state = goto[state].get(char, 0)
+            words = output[state]
+
+            if words:
+                result |= words
+
+        return result
+
+
+class RuleSet:
+    # Compiled rules of a word type, a new rule set is built when the words change
+    __slots__ = ("combined", "combined_rules", "evaluated", "fallback", "literal_filter", "matched_evaluated",
+                 "matches", "ocr_combined", "ocr_combined_rules", "ocr_fallback", "ocr_rules", "order", "rules",
+                 "samples", "searches")
+
+    def __init__(self, words: Iterable[str], combine: bool = False, prefilter: bool = False, timeout: bool = False):
+        rules = []
+
+        for word in words:
+            try:
+                rules.append((word, re.compile(word, rule_flags)))
+            except re.error as e:
+                logger.warning(f"Compile rule {word!r} error: {e}")
+
+        # With the timeout, rules are compiled again by the regex module, rules it can not compile stay with re
+        for i, (word, pattern) in enumerate(rules if timeout else []):
+            try:
+                rules[i] = (word, regex.compile(word, rule_flags | regex.V0))
+            except regex.error as e:
+                logger.warning(f"Compile rule {word!r} with timeout error: {e}")
+
+        # Rules marked with (?# nocr) are not used for text from OCR
+        self.rules: Tuple[Tuple[str, Pattern], ...] = tuple(rules)
+        self.ocr_rules: Tuple[Tuple[str, Pattern], ...] = tuple(rule for rule in rules if "(?# nocr)" not in rule[0])
+
+        # With the prefilter, only the rules whose required literals are in the text are run
+        self.literal_filter: Optional[LiteralFilter] = None
+        self.order: Dict[str, int] = {}
+
+        if prefilter:
+            self.literal_filter = LiteralFilter({word: get_literals(word) for word, _ in rules})
+            self.order = {word: i for i, (word, _) in enumerate(rules)}
+            combine = False
+
+        # In the combine mode, most rules are merged into one pattern, so a text is scanned once
+        self.combined, self.combined_rules, self.fallback = self.combine(self.rules if combine else (), timeout)
+        self.ocr_combined, self.ocr_combined_rules, self.ocr_fallback = self.combine(self.ocr_rules if combine else (),
+                                                                                     timeout)
+
+        if not combine:
+            self.fallback = self.rules
+            self.ocr_fallback = self.ocr_rules
+
+        # Statistics of the searches, and recent texts for measuring the cost of each rule
+        self.evaluated = 0
+        self.matched_evaluated = 0
+        self.matches = 0
+        self.samples: deque = deque(maxlen=16)
+        self.searches = 0
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def __repr__(self) -> str:
+        return (f"RuleSet({len(self.rules)} rules, {len(self.ocr_rules)} for OCR, "
+                f"{len(self.combined_rules)} combined, "
+                f"{len(self.rules) - len(self.literal_filter.always) if self.literal_filter else 0} filtered)")
+
+    @staticmethod
+    def combine(rules: Tuple[Tuple[str, Pattern], ...], timeout: bool = False
+                ) -> Tuple[Optional[Pattern], tuple, tuple]:
+        # Merge the rules into one alternation, return it, the merged rules and the other rules,
+        # with the timeout, the alternation is compiled by the regex module, so it can be stopped as well
+        combined_rules = tuple(rule for rule in rules if not uncombinable_pattern.search(rule[0]))
+        fallback = tuple(rule for rule in rules if uncombinable_pattern.search(rule[0]))
+
+        if not combined_rules:
+            return None, (), rules
+
+        # Capturing groups make the alternation many times slower, so the hit rule is found again after a match
+        try:
+            combined = re.compile("|".join(f"(?:{word})" for word, _ in combined_rules), rule_flags)
+        except re.error as e:
+            logger.warning(f"Combine rules error: {e}")
+            return None, (), rules
+
+        try:
+            combined = regex.compile(combined.pattern, rule_flags | regex.V0) if timeout else combined
+        except regex.error as e:
+            logger.warning(f"Combine rules with timeout error: {e}")
+
+        return combined, combined_rules, fallback
+
+    def get_mean_evaluated(self) -> float:
+        # Get the mean count of rules run before a match
+        return self.matched_evaluated / self.matches if self.matches else 0.0
+
+    def measure(self, budget: float = 0.0, slow: List[Tuple[str, float]] = None) -> Dict[str, float]:
+        # Measure the mean seconds each rule takes on the recent texts, only the rules the prefilter passes are run,
+        # a rule that runs over the budget is added to the slow list once and not run on the other texts
+        result = {}
+        samples = list(self.samples)
+
+        if not samples:
+            return result
+
+        profile = {}
+        slow_rules = []
+        slow_words = set()
+
+        for text in samples:
+            words = self.literal_filter.scan(text) if self.literal_filter is not None else None
+
+            for rule in self.rules:
+                if words is not None and rule[0] not in words or rule[0] in slow_words:
+                    continue
+
+                self.search_rules(text, (rule,), profile, budget, slow_rules)
+                slow_words.update(word for word, _ in slow_rules)
+
+        if slow is not None:
+            slow += slow_rules
+
+        for word, _ in self.rules:
+            result[word] = profile[word][0] / len(samples) if word in profile else 0.0
+
+        return result
+
+    def record(self, text: str, evaluated: int, hit: Optional[Tuple[str, Match]]):
+        # Count a search, the counts are statistics, so updates lost between threads do not matter
+        self.samples.append(text)
+        self.searches += 1
+        self.evaluated += evaluated
+
+        if hit:
+            self.matches += 1
+            self.matched_evaluated += evaluated
+
+    def reorder(self, ranks: Dict[str, float]) -> "RuleSet":
+        # Return a copy that runs the rules of higher ranks first, the compiled rules and the prefilter are shared
+        result = copy(self)
+
+        def key(rule: Tuple[str, Pattern]) -> float:
+            return -ranks.get(rule[0], 0)
+
+        result.rules = tuple(sorted(self.rules, key=key))
+        result.ocr_rules = tuple(sorted(self.ocr_rules, key=key))
+        result.fallback = tuple(sorted(self.fallback, key=key))
+        result.ocr_fallback = tuple(sorted(self.ocr_fallback, key=key))
+
+        if self.order:
+            result.order = {word: i for i, (word, _) in enumerate(result.rules)}
+
+        result.evaluated = 0
+        result.matched_evaluated = 0
+        result.matches = 0
+        result.samples = deque(self.samples, maxlen=self.samples.maxlen)
+        result.searches = 0
+
+        return result
+
+    def search(self, text: str, ocr: bool = False, profile: Dict[str, list] = None, budget: float = 0.0,
+               slow: List[Tuple[str, float]] = None) -> Optional[Tuple[str, Match]]:
+        # Return the first hit rule and its match, with a profile given, the time of each rule is added to it,
+        # rules that run over the budget are added to the slow list
+        combined = self.ocr_combined if ocr else self.combined
+
+        if self.literal_filter is not None:
+            rules = [self.rules[i] for i in sorted(self.order[word] for word in self.literal_filter.scan(text))]
+            rules = [rule for rule in rules if "(?# nocr)" not in rule[0]] if ocr else rules
+        else:
+            rules = self.ocr_fallback if ocr else self.fallback
+
+        # A combined search stopped by the timeout runs every rule, so the slow rules are found
+        try:
+            if combined is not None and search_pattern(combined, text, budget):
+                rules = self.ocr_rules if ocr else self.rules
+        except TimeoutError:
+            rules = self.ocr_rules if ocr else self.rules
+
+        hit, evaluated = self.search_rules(text, rules, profile, budget, slow)
+        self.record(text, evaluated, hit)
+
+        return hit
+
+    @staticmethod
+    def search_rules(text: str, rules: Iterable[Tuple[str, Pattern]], profile: Dict[str, list] = None,
+                     budget: float = 0.0, slow: List[Tuple[str, float]] = None
+                     ) -> Tuple[Optional[Tuple[str, Match]], int]:
+        # Return the first hit rule in the rules, and the count of rules run,
+        # the profile maps a rule to its total seconds and calls, updates lost between threads do not matter,
+        # a rule that runs over the budget is added to the slow list, rules compiled by the regex module are stopped,
+        # the time is the CPU time of this thread, so the time other threads hold the GIL is not counted
+        evaluated = 0
+
+        for word, pattern in rules:
+            evaluated += 1
+
+            if profile is None and not budget:
+                match = pattern.search(text)
+            else:
+                start = thread_time()
+                stopped = False
+
+                try:
+                    match = search_pattern(pattern, text, budget)
+                except TimeoutError:
+                    match = None
+                    stopped = True
+
+                seconds = thread_time() - start
+
+                if profile is not None:
+                    stats = profile.get(word) or profile.setdefault(word, [0.0, 0])
+                    stats[0] += seconds
+                    stats[1] += 1
+
+                if budget and (stopped or seconds > budget) and slow is not None:
+                    slow.append((word, max(seconds, budget)))
+
+            if match:
+                return (word, match), evaluated
+
+        return None, evaluated
+
+
+def fold_text(text: str) -> str:
+    # Fold the case of the text and remove all whitespace, as literals are matched against
+    return "".join(text.translate(fold_table).casefold().split())
+
+
+def get_literals(word: str) -> Optional[FrozenSet[str]]:
+    # Get the literals of which at least one is in every text the rule matches
+    result = None
+
+    try:
+        result = get_required(sre_parse.parse(word, rule_flags))
+    except Exception as e:
+        logger.warning(f"Get literals of {word!r} error: {e}")
+
+    return result
+
+
+def get_required(items) -> Optional[FrozenSet[str]]:
+    # Get the best required literals of a parsed sequence, whitespace is skipped because the text is folded
+    candidates = []
+    run = []
+
+    for op, av in items:
+        if op is sre_parse.LITERAL and not chr(av).isspace():
+            run.append(chr(av))
+            continue
+
+        if op in zero_width_ops or is_space(op, av):
+            continue
+
+        if run:
+            candidates.append(frozenset({fold_text("".join(run))}))
+            run = []
+
+        if op is sre_parse.SUBPATTERN:
+            candidates.append(get_required(av[-1]))
+        elif op is getattr(sre_parse, "ATOMIC_GROUP", None):
+            candidates.append(get_required(av))
+        elif op in repeat_ops and av[0] >= 1:
+            candidates.append(get_required(av[2]))
+        elif op is sre_parse.BRANCH:
+            branches = [get_required(branch) for branch in av[1]]
+            candidates.append(None if not all(branches) else frozenset().union(*branches))
+        elif op is sre_parse.IN and len(av) <= 8 and all(i_op is sre_parse.LITERAL for i_op, _ in av):
+            candidates.append(frozenset(fold_text(chr(i_av)) for _, i_av in av))
+
+    if run:
+        candidates.append(frozenset({fold_text("".join(run))}))
+
+    candidates = [c for c in candidates if c and all(c)]
+
+    if not candidates:
+        return None
+
+    # Prefer the literals whose shortest one is the longest, then the fewer ones
+    return max(candidates, key=lambda c: (min(len(s) for s in c), -len(c)))
+
+
+def is_space(op, av) -> bool:
+    # Check if a parsed item only matches whitespace
+    if op is sre_parse.LITERAL:
+        return chr(av).isspace()
+
+    if op is sre_parse.IN:
+        return all((i_op is sre_parse.CATEGORY and i_av is sre_parse.CATEGORY_SPACE)
+                   or (i_op is sre_parse.LITERAL and chr(i_av).isspace())
+                   for i_op, i_av in av)
+
+    if op in repeat_ops:
+        return all(is_space(i_op, i_av) for i_op, i_av in av[2])
+
+    return False
+
+
+def search_pattern(pattern: Pattern, text: str, budget: float = 0.0) -> Optional[Match]:
+    # Search the text, a pattern compiled by the regex module raises TimeoutError after the budget
+    if budget and type(pattern) is not re_pattern_type:
+        return pattern.search(text, timeout=budget)
+
+    return pattern.search(text)
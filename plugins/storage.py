@@ -0,0 +1,535 @@
+# SCP-079-AVATAR - Get newly joined member's profile photo
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-AVATAR.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import pickle
+import sqlite3
+import sys
+from array import array
+from mmap import ACCESS_READ, mmap
+from os import O_RDONLY, close, fsync, listdir, mkdir, open as os_open, replace
+from os.path import dirname, exists, getmtime
+from struct import Struct
+from time import perf_counter
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from zlib import crc32
+
+from .structures import SortedIdSet, UserStatus
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+# Id array header: magic, format version, count of ids, padded to keep the int64 array aligned
+ids_header = Struct("<4sB3xQ")
+ids_magic = b"I079"
+ids_version = 1
+
+# Snapshot header: magic, format version, body length, body CRC32
+snapshot_header = Struct("<4sBQI")
+snapshot_magic = b"S079"
+snapshot_version = 1
+
+
+def append_journal(path: str, records: List[tuple]) -> int:
+    # Append records to a journal file, return the journal's size
+    result = 0
+
+    try:
+        with open(path, "ab") as f:
+            pickle.dump(records, f, pickle.HIGHEST_PROTOCOL)
+            result = f.tell()
+    except Exception as e:
+        logger.warning(f"Append journal error: {e}", exc_info=True)
+
+    return result
+
+
+def apply_user_record(user_ids: Dict[int, UserStatus], record: tuple) -> bool:
+    # Apply a journal record to the user_ids map
+    result = False
+
+    try:
+        action, *args = record
+
+        if action == "clear":
+            user_ids.clear()
+        elif action == "join_clear":
+            for uid in user_ids:
+                user_ids[uid].clear_join()
+        elif action == "init":
+            uid, = args
+
+            if user_ids.get(uid) is None:
+                user_ids[uid] = UserStatus()
+        elif action == "reset":
+            uid, = args
+            user_ids[uid] = UserStatus()
+        elif args[0] not in user_ids:
+            return False
+        elif action == "avatar":
+            uid, file_id = args
+            user_ids[uid].avatar = file_id
+        elif action == "join":
+            uid, gid, joined = args
+            user_ids[uid].set_join(gid, joined)
+        elif action == "join_pop":
+            uid, gid = args
+            user_ids[uid].pop_join(gid)
+        elif action == "message":
+            uid, gid, mid = args
+            user_ids[uid].add_message(gid, mid)
+        elif action == "message_clear":
+            uid, = args
+            user_ids[uid].clear_message()
+        elif action == "score":
+            uid, project, score = args
+            user_ids[uid].set_score(project, score)
+        else:
+            return False
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Apply user record error: {e}", exc_info=True)
+
+    return result
+
+
+def connect_database(path: str) -> Optional[sqlite3.Connection]:
+    # Connect to the SQLite database, create the tables if necessary
+    result = None
+
+    try:
+        scores = ", ".join(f"{project} REAL NOT NULL DEFAULT 0.0" for project in UserStatus.projects)
+
+        result = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        result.execute("PRAGMA journal_mode = WAL")
+        result.execute("PRAGMA synchronous = NORMAL")
+        result.executescript(
+            f"CREATE TABLE IF NOT EXISTS users (uid INTEGER PRIMARY KEY, avatar TEXT NOT NULL DEFAULT '', {scores});"
+            "DROP INDEX IF EXISTS users_score;"
+            "CREATE TABLE IF NOT EXISTS joins (uid INTEGER, gid INTEGER, time INTEGER, PRIMARY KEY (uid, gid));"
+            "CREATE INDEX IF NOT EXISTS joins_time ON joins (time);"
+            "CREATE TABLE IF NOT EXISTS messages (uid INTEGER, gid INTEGER, mid INTEGER, "
+            "PRIMARY KEY (uid, gid, mid)) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS counts (uid INTEGER, gid INTEGER, count INTEGER NOT NULL, "
+            "PRIMARY KEY (uid, gid)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS counts_count ON counts (count);"
+            "CREATE TABLE IF NOT EXISTS watches (type TEXT, uid INTEGER, until INTEGER, PRIMARY KEY (type, uid));"
+            "CREATE TABLE IF NOT EXISTS waits (uid INTEGER, gid INTEGER, PRIMARY KEY (uid, gid));"
+        )
+
+        # Count the messages of databases created by older versions
+        with result:
+            result.execute("BEGIN")
+            result.execute("INSERT INTO counts (uid, gid, count) SELECT uid, gid, COUNT(*) FROM messages "
+                           "WHERE NOT EXISTS (SELECT 1 FROM counts) GROUP BY uid, gid")
+    except Exception as e:
+        logger.critical(f"Connect database error: {e}", exc_info=True)
+
+    return result
+
+
+def execute_user_record(conn: sqlite3.Connection, record: tuple) -> bool:
+    # Execute a journal record of the user_ids map in the database
+    result = False
+
+    try:
+        action, *args = record
+
+        if action == "clear":
+            conn.execute("DELETE FROM users")
+            conn.execute("DELETE FROM joins")
+            conn.execute("DELETE FROM messages")
+            conn.execute("DELETE FROM counts")
+        elif action == "join_clear":
+            conn.execute("DELETE FROM joins")
+        elif action == "init":
+            conn.execute("INSERT OR IGNORE INTO users (uid) VALUES (?)", args)
+        elif action == "reset":
+            conn.execute("INSERT OR REPLACE INTO users (uid) VALUES (?)", args)
+            conn.execute("DELETE FROM joins WHERE uid = ?", args)
+            conn.execute("DELETE FROM messages WHERE uid = ?", args)
+            conn.execute("DELETE FROM counts WHERE uid = ?", args)
+        elif action == "avatar":
+            uid, file_id = args
+            conn.execute("UPDATE users SET avatar = ? WHERE uid = ?", (file_id, uid))
+        elif action == "join":
+            conn.execute("INSERT OR REPLACE INTO joins (uid, gid, time) VALUES (?, ?, ?)", args)
+        elif action == "join_pop":
+            conn.execute("DELETE FROM joins WHERE uid = ? AND gid = ?", args)
+        elif action == "message":
+            uid, gid, mid = args
+
+            # Only a new message is counted
+            if conn.execute("INSERT OR IGNORE INTO messages (uid, gid, mid) VALUES (?, ?, ?)", args).rowcount:
+                conn.execute("INSERT OR IGNORE INTO counts (uid, gid, count) VALUES (?, ?, 0)", (uid, gid))
+                conn.execute("UPDATE counts SET count = count + 1 WHERE uid = ? AND gid = ?", (uid, gid))
+        elif action == "message_clear":
+            conn.execute("DELETE FROM messages WHERE uid = ?", args)
+            conn.execute("DELETE FROM counts WHERE uid = ?", args)
+        elif action == "score" and args[1] in UserStatus.project_index:
+            uid, project, score = args
+            conn.execute(f"UPDATE users SET {project} = ? WHERE uid = ?", (score, uid))
+        else:
+            return False
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Execute user record error: {e}", exc_info=True)
+
+    return result
+
+
+def load_data(file: str, default: Any, sharded: bool, shards: int = 0) -> Tuple[Any, bool, float]:
+    # Load a data file, return the data, whether it should be saved again, and the seconds used
+    start = perf_counter()
+    result = default
+    dirty = False
+
+    try:
+        if sharded and exists(f"data/{file}.d"):
+            result, dirty = read_shards(f"data/{file}.d", shards)
+        elif exists(f"data/{file}") or exists(f"data/.{file}"):
+            result = read_snapshot(f"data/{file}")
+            dirty = sharded
+        elif sharded:
+            mkdir(f"data/{file}.d")
+        else:
+            write_snapshot(f"data/{file}", default)
+    except Exception as e:
+        logger.error(f"Load data {file} error: {e}", exc_info=True)
+
+        # The backup copy written by older versions
+        result = read_snapshot(f"data/.{file}")
+        dirty = True
+
+    return result, dirty, perf_counter() - start
+
+
+def query_message_users(conn: sqlite3.Connection, limit: int) -> Set[int]:
+    # Get users who have sent more than limit messages in a group
+    result = set()
+
+    try:
+        cursor = conn.execute("SELECT uid FROM counts WHERE count > ?", (limit,))
+        result = {row[0] for row in cursor}
+    except Exception as e:
+        logger.warning(f"Query message users error: {e}", exc_info=True)
+
+    return result
+
+
+def query_new_users(conn: sqlite3.Connection, since: int) -> Set[int]:
+    # Get users who joined a group after the time
+    result = set()
+
+    try:
+        cursor = conn.execute("SELECT DISTINCT uid FROM joins WHERE time > ?", (since,))
+        result = {row[0] for row in cursor}
+    except Exception as e:
+        logger.warning(f"Query new users error: {e}", exc_info=True)
+
+    return result
+
+
+def query_watching_count(conn: sqlite3.Connection) -> int:
+    # Get the count of users who have message records
+    result = 0
+
+    try:
+        result = conn.execute("SELECT COUNT(DISTINCT uid) FROM counts").fetchone()[0]
+    except Exception as e:
+        logger.warning(f"Query watching count error: {e}", exc_info=True)
+
+    return result
+
+
+def read_ids(path: str) -> SortedIdSet:
+    # Map an id array file, the ids are read from the page cache on demand
+    with open(path, "rb") as f:
+        buffer = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+    magic, version, count = ids_header.unpack_from(buffer)
+
+    if magic != ids_magic or version > ids_version:
+        raise ValueError(f"Unknown id array format {magic!r} {version}")
+
+    if len(buffer) != ids_header.size + count * 8:
+        raise ValueError("Id array length mismatch")
+
+    if sys.byteorder == "little":
+        return SortedIdSet(memoryview(buffer)[ids_header.size:].cast("q"), buffer)
+
+    # The file is always little-endian
+    base = array("q", buffer[ids_header.size:])
+    base.byteswap()
+    buffer.close()
+
+    return SortedIdSet(base)
+
+
+def read_journal(path: str) -> List[tuple]:
+    # Read all records from a journal file
+    result = []
+
+    if not exists(path):
+        return []
+
+    with open(path, "rb") as f:
+        while True:
+            try:
+                result += pickle.load(f)
+            except EOFError:
+                break
+            except Exception as e:
+                logger.error(f"Read journal {path} stopped at a torn record: {e}")
+                break
+
+    return result
+
+
+def read_shards(path: str, shards: int = 0) -> Tuple[dict, bool]:
+    # Read all shard files in a directory, merge them into one map, return it and whether it is stale
+    # A key is in the shard key % shards, or in its own shard if shards is 0
+    result = {}
+    stale = {}
+
+    # Files left by an older shard count are read by age, so a newer copy of a key overrides an older one
+    name_list = sorted((name for name in listdir(path) if not name.endswith(".tmp")),
+                       key=lambda name: getmtime(f"{path}/{name}"))
+
+    for name in name_list:
+        data = read_snapshot(f"{path}/{name}")
+        shard = int(name)
+
+        if all((key % shards if shards else key) == shard for key in data):
+            result.update(data)
+            continue
+
+        for key in data:
+            if (key % shards if shards else key) == shard:
+                result[key] = data[key]
+            else:
+                stale[key] = data[key]
+
+    # Keys in the wrong shard were saved before the shard count changed, the current shard has the newer value
+    for key in stale:
+        result.setdefault(key, stale[key])
+
+    return result, bool(stale) or any(shards and int(name) >= shards for name in name_list)
+
+
+def read_snapshot(path: str) -> Any:
+    # Read a snapshot file, files without the header are plain pickles of older versions
+    with open(path, "rb") as f:
+        head = f.read(snapshot_header.size)
+
+        if not head.startswith(snapshot_magic):
+            f.seek(0)
+            return pickle.load(f)
+
+        _, version, length, checksum = snapshot_header.unpack(head)
+        body = f.read()
+
+    if version > snapshot_version:
+        raise ValueError(f"Unknown snapshot version {version}")
+
+    if len(body) != length or crc32(body) != checksum:
+        raise ValueError("Snapshot checksum mismatch")
+
+    return pickle.loads(body)
+
+
+def read_users(conn: sqlite3.Connection) -> Dict[int, UserStatus]:
+    # Read the user_ids map from the database
+    result = {}
+
+    for row in conn.execute(f"SELECT uid, avatar, {', '.join(UserStatus.projects)} FROM users"):
+        uid, avatar, *scores = row
+        result[uid] = UserStatus()
+        result[uid].avatar = avatar
+        result[uid].set_scores(scores)
+
+    for uid, gid, joined in conn.execute("SELECT uid, gid, time FROM joins"):
+        if uid not in result:
+            continue
+
+        result[uid].set_join(gid, joined)
+
+    for uid, gid, mid in conn.execute("SELECT uid, gid, mid FROM messages"):
+        if uid not in result:
+            continue
+
+        result[uid].add_message(gid, mid)
+
+    return result
+
+
+def read_waits(conn: sqlite3.Connection) -> Dict[int, Set[int]]:
+    # Read the white_wait_ids map from the database
+    result = {}
+
+    for uid, gid in conn.execute("SELECT uid, gid FROM waits"):
+        result.setdefault(uid, set()).add(gid)
+
+    return result
+
+
+def read_watches(conn: sqlite3.Connection) -> Dict[str, Dict[int, int]]:
+    # Read the watch_ids map from the database
+    result = {
+        "ban": {},
+        "delete": {}
+    }
+
+    for the_type, uid, until in conn.execute("SELECT type, uid, until FROM watches"):
+        result.setdefault(the_type, {})[uid] = until
+
+    return result
+
+
+def truncate_journal(path: str) -> bool:
+    # Truncate a journal file after its records are in the snapshot
+    result = False
+
+    try:
+        with open(path, "wb"):
+            pass
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Truncate journal error: {e}", exc_info=True)
+
+    return result
+
+
+def write_atomic(path: str, parts: List[bytes]) -> int:
+    # Write a file atomically, return the count of written bytes
+    path_tmp = f"{path}.tmp"
+
+    with open(path_tmp, "wb") as f:
+        for part in parts:
+            f.write(part)
+
+        f.flush()
+        fsync(f.fileno())
+
+    replace(path_tmp, path)
+
+    # Make the rename itself durable
+    fd = os_open(dirname(path) or ".", O_RDONLY)
+
+    try:
+        fsync(fd)
+    finally:
+        close(fd)
+
+    return sum(len(part) for part in parts)
+
+
+def write_ids(path: str, ids: Iterable[int]) -> int:
+    # Write ids to an id array file, return the count of written bytes
+    body = array("q", sorted(ids))
+    sys.byteorder == "little" or body.byteswap()
+
+    return write_atomic(path, [ids_header.pack(ids_magic, ids_version, len(body)), body.tobytes()])
+
+
+def write_snapshot(path: str, data: Any) -> int:
+    # Write a snapshot file atomically, return the count of written bytes
+    body = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    head = snapshot_header.pack(snapshot_magic, snapshot_version, len(body), crc32(body))
+
+    return write_atomic(path, [head, body])
+
+
+def write_users(conn: sqlite3.Connection, user_ids: Dict[int, UserStatus]) -> bool:
+    # Rewrite the user_ids map in the database
+    result = False
+
+    try:
+        projects = UserStatus.projects
+        uids = list(user_ids)
+        users = [(uid, user_ids[uid].avatar, *user_ids[uid].score) for uid in uids]
+        joins = [(uid, gid, joined) for uid in uids for gid, joined in list(user_ids[uid].join.items())]
+        messages = []
+        counts = []
+
+        for uid in uids:
+            for gid, mids in list(user_ids[uid].message.items()):
+                mids = list(mids)
+
+                if not mids:
+                    continue
+
+                messages += [(uid, gid, mid) for mid in mids]
+                counts.append((uid, gid, len(mids)))
+
+        with conn:
+            conn.execute("BEGIN")
+            execute_user_record(conn, ("clear",))
+            conn.executemany(f"INSERT INTO users (uid, avatar, {', '.join(projects)}) "
+                             f"VALUES (?, ?, {', '.join('?' for _ in projects)})", users)
+            conn.executemany("INSERT INTO joins (uid, gid, time) VALUES (?, ?, ?)", joins)
+            conn.executemany("INSERT INTO messages (uid, gid, mid) VALUES (?, ?, ?)", messages)
+            conn.executemany("INSERT INTO counts (uid, gid, count) VALUES (?, ?, ?)", counts)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Write users error: {e}", exc_info=True)
+
+    return result
+
+
+def write_waits(conn: sqlite3.Connection, white_wait_ids: Dict[int, Set[int]]) -> bool:
+    # Rewrite the white_wait_ids map in the database
+    result = False
+
+    try:
+        waits = [(uid, gid) for uid, gids in list(white_wait_ids.items()) for gid in list(gids)]
+
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM waits")
+            conn.executemany("INSERT INTO waits (uid, gid) VALUES (?, ?)", waits)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Write waits error: {e}", exc_info=True)
+
+    return result
+
+
+def write_watches(conn: sqlite3.Connection, watch_ids: Dict[str, Dict[int, int]]) -> bool:
+    # Rewrite the watch_ids map in the database
+    result = False
+
+    try:
+        watches = [(the_type, uid, until) for the_type in list(watch_ids)
+                   for uid, until in list(watch_ids[the_type].items())]
+
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM watches")
+            conn.executemany("INSERT INTO watches (type, uid, until) VALUES (?, ?, ?)", watches)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Write watches error: {e}", exc_info=True)
+
+    return result
@@ -0,0 +1,646 @@
+# SCP-079-AVATAR - Get newly joined member's profile photo
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-AVATAR.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from heapq import merge
+from threading import Lock, Thread, current_thread, local
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Set, Tuple, Union
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+# Read-only empty map returned for maps that are not allocated yet
+empty_map: Mapping = MappingProxyType({})
+
+
+class HitCounter:
+    # Regex hit counts of each thread, a thread only writes its own counts, so counting takes no lock,
+    # the counts only grow, and merging takes what has been added since the last merge
+    __slots__ = ("lock", "_local", "_threads")
+
+    def __init__(self):
+        self.lock = Lock()
+        self._local = local()
+        self._threads: List[Tuple[Thread, Dict[Tuple[str, str], int], Dict[Tuple[str, str], int]]] = []
+
+    def __len__(self) -> int:
+        return len(self._threads)
+
+    def __repr__(self) -> str:
+        return f"HitCounter({len(self._threads)} threads)"
+
+    def add(self, word_type: str, word: str, count: int = 1):
+        counts = getattr(self._local, "counts", None)
+
+        if counts is None:
+            counts = self._local.counts = {}
+
+            with self.lock:
+                self._threads.append((current_thread(), counts, {}))
+
+        key = (word_type, word)
+        counts[key] = counts.get(key, 0) + count
+        records = getattr(self._local, "records", None)
+
+        if records:
+            records[-1].append(key)
+
+    def merge(self) -> Dict[str, Dict[str, int]]:
+        # Return the hits added since the last merge, by word type and word
+        result = {}
+
+        with self.lock:
+            threads = []
+
+            for thread, counts, merged in self._threads:
+                # Copying a dict is atomic, the owner thread may be counting meanwhile,
+                # counts of a thread that had ended before the copy are final, so the thread is dropped
+                if thread.is_alive():
+                    threads.append((thread, counts, merged))
+
+                for key, count in counts.copy().items():
+                    added = count - merged.get(key, 0)
+
+                    if not added:
+                        continue
+
+                    merged[key] = count
+                    word_type, word = key
+                    result.setdefault(word_type, {})
+                    result[word_type][word] = result[word_type].get(word, 0) + added
+
+            self._threads = threads
+
+        return result
+
+    def start(self):
+        # Record the hits of this thread from now on, records can be nested
+        records = getattr(self._local, "records", None)
+
+        if records is None:
+            records = self._local.records = []
+
+        records.append([])
+
+    def stop(self) -> List[Tuple[str, str]]:
+        # Stop the last record and return its hits, which are also added to the outer record
+        records = self._local.records
+        result = records.pop()
+
+        if records:
+            records[-1].extend(result)
+
+        return result
+
+
+class IntSet:
+    # A compressed set of integers, values are split into chunks by the high bits,
+    # a chunk is a sorted array of the low 16 bits, or a bitmap once it holds array_max values
+    __slots__ = ("_chunks",)
+
+    array_max = 4096
+    bitmap_size = 8192
+
+    def __init__(self, values: Iterable[int] = ()):
+        self._chunks: Dict[int, Union[array, bytearray]] = {}
+
+        for value in values:
+            self.add(value)
+
+    def __bool__(self) -> bool:
+        return bool(self._chunks)
+
+    def __contains__(self, value: int) -> bool:
+        chunk = self._chunks.get(value >> 16)
+        return chunk is not None and self.chunk_contains(chunk, value & 0xFFFF)
+
+    def __getstate__(self) -> dict:
+        return {high: chunk.tobytes() if isinstance(chunk, array) else bytes(chunk)
+                for high, chunk in self._chunks.items()}
+
+    def __iter__(self) -> Iterator[int]:
+        for high in sorted(self._chunks):
+            base = high << 16
+
+            for low in self.chunk_values(self._chunks[high]):
+                yield base | low
+
+    def __len__(self) -> int:
+        return sum(self.chunk_len(chunk) for chunk in self._chunks.values())
+
+    def __repr__(self) -> str:
+        return f"IntSet({list(self)!r})"
+
+    def __setstate__(self, state: dict):
+        self._chunks = {}
+
+        for high, data in state.items():
+            if len(data) == self.bitmap_size:
+                self._chunks[high] = bytearray(data)
+            else:
+                chunk = array("H")
+                chunk.frombytes(data)
+                self._chunks[high] = chunk
+
+    def __sub__(self, other: "IntSet") -> "IntSet":
+        if not isinstance(other, IntSet):
+            return NotImplemented
+
+        return self.difference(other)
+
+    def add(self, value: int):
+        high, low = value >> 16, value & 0xFFFF
+        chunk = self._chunks.get(high)
+
+        if chunk is None:
+            self._chunks[high] = array("H", [low])
+        elif isinstance(chunk, bytearray):
+            chunk[low >> 3] |= 1 << (low & 7)
+        else:
+            i = bisect_left(chunk, low)
+
+            if i < len(chunk) and chunk[i] == low:
+                return
+
+            if len(chunk) < self.array_max - 1:
+                chunk.insert(i, low)
+                return
+
+            bitmap = self.to_bitmap(chunk)
+            bitmap[low >> 3] |= 1 << (low & 7)
+            self._chunks[high] = bitmap
+
+    @classmethod
+    def chunk_contains(cls, chunk: Union[array, bytearray], low: int) -> bool:
+        if isinstance(chunk, bytearray):
+            return bool(chunk[low >> 3] >> (low & 7) & 1)
+
+        i = bisect_left(chunk, low)
+
+        return i < len(chunk) and chunk[i] == low
+
+    @classmethod
+    def chunk_len(cls, chunk: Union[array, bytearray]) -> int:
+        if isinstance(chunk, bytearray):
+            return bin(int.from_bytes(chunk, "little")).count("1")
+
+        return len(chunk)
+
+    @classmethod
+    def chunk_values(cls, chunk: Union[array, bytearray]) -> Iterator[int]:
+        if isinstance(chunk, array):
+            return iter(chunk)
+
+        return (i << 3 | bit for i, byte in enumerate(chunk) if byte for bit in range(8) if byte >> bit & 1)
+
+    def difference(self, other: "IntSet") -> "IntSet":
+        # Return a new set with the values that are not in the other set, chunk by chunk
+        result = IntSet()
+
+        for high, chunk in self._chunks.items():
+            other_chunk = other._chunks.get(high)
+
+            if other_chunk is None:
+                result._chunks[high] = chunk[:]
+            elif isinstance(chunk, array):
+                if isinstance(other_chunk, bytearray):
+                    values = array("H", [low for low in chunk if not other_chunk[low >> 3] >> (low & 7) & 1])
+                else:
+                    values = array("H", [low for low in chunk if not self.chunk_contains(other_chunk, low)])
+
+                if values:
+                    result._chunks[high] = values
+            else:
+                bits = int.from_bytes(chunk, "little") & ~int.from_bytes(self.to_bitmap(other_chunk), "little")
+
+                if bits:
+                    result._chunks[high] = self.from_bits(bits)
+
+        return result
+
+    def discard(self, value: int):
+        high, low = value >> 16, value & 0xFFFF
+        chunk = self._chunks.get(high)
+
+        if chunk is None:
+            return
+
+        if isinstance(chunk, bytearray):
+            chunk[low >> 3] &= ~(1 << (low & 7)) & 0xFF
+
+            if not any(chunk):
+                self._chunks.pop(high)
+
+            return
+
+        i = bisect_left(chunk, low)
+
+        if i < len(chunk) and chunk[i] == low:
+            del chunk[i]
+
+        if not chunk:
+            self._chunks.pop(high)
+
+    @classmethod
+    def from_bits(cls, bits: int) -> Union[array, bytearray]:
+        # Get the smallest chunk of an integer bitmap
+        result = bytearray(bits.to_bytes(cls.bitmap_size, "little"))
+
+        if bin(bits).count("1") < cls.array_max:
+            result = array("H", cls.chunk_values(result))
+
+        return result
+
+    @classmethod
+    def to_bitmap(cls, chunk: Union[array, bytearray]) -> bytearray:
+        if isinstance(chunk, bytearray):
+            return chunk
+
+        result = bytearray(cls.bitmap_size)
+
+        for low in chunk:
+            result[low >> 3] |= 1 << (low & 7)
+
+        return result
+
+
+class RecentIds:
+    # Recently added ids of a fixed capacity, ids expire after the ttl, the least recently used are dropped first
+    __slots__ = ("capacity", "hits", "misses", "ttl", "_ids")
+
+    def __init__(self, capacity: int, ttl: int):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.ttl = ttl
+        self._ids: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __repr__(self) -> str:
+        return f"RecentIds({list(self._ids)!r}, capacity={self.capacity}, ttl={self.ttl})"
+
+    def add(self, value: int, now: int):
+        self._ids.pop(value, None)
+        self._ids[value] = now + self.ttl
+
+        while len(self._ids) > self.capacity:
+            self._ids.popitem(last=False)
+
+    def contains(self, value: int, now: int) -> bool:
+        # Single pop and set operations only, so lookups from other threads can not break the order
+        expire = self._ids.pop(value, 0)
+
+        if expire > now:
+            self._ids[value] = expire
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        return expire > now
+
+
+class SortedIdSet:
+    # A set of ids on a sorted read-only base array, which is usually memory-mapped,
+    # ids added or removed after the array is written are kept in the overlay sets
+    __slots__ = ("lock", "_added", "_base", "_buffer", "_removed")
+
+    def __init__(self, base: Sequence[int] = (), buffer: Any = None):
+        # The buffer is the object the base array is a view of, keep it alive with the view
+        self.lock = Lock()
+        self._added: Set[int] = set()
+        self._base = base
+        self._buffer = buffer
+        self._removed: Set[int] = set()
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def __contains__(self, value: int) -> bool:
+        if value in self._added:
+            return True
+
+        if value in self._removed:
+            return False
+
+        return self.base_contains(value)
+
+    def __iter__(self) -> Iterator[int]:
+        removed = set(self._removed)
+        return merge((value for value in self._base if value not in removed), sorted(self._added))
+
+    def __len__(self) -> int:
+        return len(self._base) + len(self._added) - len(self._removed)
+
+    def __reduce__(self) -> tuple:
+        # Pickle as a plain set, so the data can be shared with other bots
+        return set, (list(self),)
+
+    def __repr__(self) -> str:
+        return f"SortedIdSet({len(self)} ids, {len(self._added)} added, {len(self._removed)} removed)"
+
+    def add(self, value: int):
+        with self.lock:
+            if value in self._removed:
+                self._removed.discard(value)
+            elif not self.base_contains(value):
+                self._added.add(value)
+
+    def base_contains(self, value: int) -> bool:
+        # Read the base once, a rebase may replace it meanwhile
+        base = self._base
+        i = bisect_left(base, value)
+        return i < len(base) and base[i] == value
+
+    def discard(self, value: int):
+        with self.lock:
+            if value in self._added:
+                self._added.discard(value)
+            elif self.base_contains(value):
+                self._removed.add(value)
+
+    def rebase(self, other: "SortedIdSet"):
+        # Use the base array of a newly written set which already contains the overlay, the lock should be held,
+        # readers do not take the lock, so the new base is set before the overlay is dropped,
+        # a reader that sees the new base with the old overlay gets the same answer
+        self._buffer = other._buffer
+        self._base = other._base
+        self._added = set()
+        self._removed = set()
+
+    def update(self, values: Iterable[int]):
+        for value in values:
+            self.add(value)
+
+
+class UserStatus:
+    # A user's status, the join map, the message map and the score array are allocated on first write
+    __slots__ = ("avatar", "_join", "_message", "_score")
+
+    projects = ("captcha", "clean", "lang", "long", "noflood", "noporn", "nospam", "warn")
+    project_index = {project: i for i, project in enumerate(projects)}
+    zero_scores = (0.0,) * len(projects)
+
+    def __init__(self):
+        self.avatar: str = ""
+        self._join: Optional[Dict[int, int]] = None
+        self._message: Optional[Dict[int, IntSet]] = None
+        self._score: Optional[array] = None
+
+    def __getstate__(self) -> tuple:
+        return self.avatar, self._join, self._message, self._score and self._score.tobytes()
+
+    def __setstate__(self, state: tuple):
+        self.avatar, self._join, self._message, score = state
+        self._message and convert_id_sets(self._message)
+        self._score = array("d", score) if score else None
+
+    def __repr__(self) -> str:
+        return (f"UserStatus(avatar={self.avatar!r}, join={dict(self.join)!r}, "
+                f"message={dict(self.message)!r}, score={self.get_scores()!r})")
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "UserStatus":
+        # Convert the dict format of older versions
+        result = cls()
+        result.avatar = data.get("avatar", "")
+        result._join = data.get("join") or None
+        result._message = data.get("message") or None
+        result._message and convert_id_sets(result._message)
+
+        for project, score in data.get("score", {}).items():
+            score and result.set_score(project, score)
+
+        return result
+
+    @property
+    def join(self) -> Mapping[int, int]:
+        return self._join if self._join is not None else empty_map
+
+    @property
+    def message(self) -> Mapping[int, IntSet]:
+        return self._message if self._message is not None else empty_map
+
+    @property
+    def score(self) -> Sequence[float]:
+        return self._score if self._score is not None else self.zero_scores
+
+    def add_message(self, gid: int, mid: int):
+        if self._message is None:
+            self._message = {}
+
+        mids = self._message.get(gid)
+
+        if mids is None:
+            mids = self._message[gid] = IntSet()
+
+        mids.add(mid)
+
+    def clear_join(self):
+        self._join = None
+
+    def clear_message(self):
+        self._message = None
+
+    def get_score(self, project: str) -> float:
+        return self.score[self.project_index[project]]
+
+    def get_scores(self) -> Dict[str, float]:
+        return dict(zip(self.projects, self.score))
+
+    def pop_join(self, gid: int) -> int:
+        if not self._join:
+            return 0
+
+        result = self._join.pop(gid, 0)
+        self._join = self._join or None
+
+        return result
+
+    def set_join(self, gid: int, joined: int):
+        if self._join is None:
+            self._join = {}
+
+        self._join[gid] = joined
+
+    def set_score(self, project: str, score: float):
+        if self._score is None:
+            self._score = array("d", self.zero_scores)
+
+        self._score[self.project_index[project]] = score
+
+    def set_scores(self, scores: Sequence[float]):
+        self._score = array("d", scores) if any(scores) else None
+
+    def total_score(self) -> float:
+        return sum(self.score)
+
+
+class VerdictCache:
+    # Recent verdicts of a fixed capacity, verdicts expire after the ttl, the least recently used are dropped first
+    __slots__ = ("capacity", "hits", "lock", "misses", "ttl", "_verdicts")
+
+    def __init__(self, capacity: int, ttl: int):
+        self.capacity = capacity
+        self.hits = 0
+        self.lock = Lock()
+        self.misses = 0
+        self.ttl = ttl
+        self._verdicts: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._verdicts)
+
+    def __repr__(self) -> str:
+        return f"VerdictCache({len(self._verdicts)} verdicts, capacity={self.capacity}, ttl={self.ttl})"
+
+    def get(self, key: Any, now: int) -> Any:
+        # Return the verdict of the key, or None if it is not cached or expired
+        with self.lock:
+            expire, verdict = self._verdicts.pop(key, (0, None))
+
+            if expire > now:
+                self._verdicts[key] = (expire, verdict)
+                self.hits += 1
+            else:
+                self.misses += 1
+                verdict = None
+
+        return verdict
+
+    def set(self, key: Any, verdict: Any, now: int):
+        with self.lock:
+            self._verdicts.pop(key, None)
+            self._verdicts[key] = (now + self.ttl, verdict)
+
+            while len(self._verdicts) > self.capacity:
+                self._verdicts.popitem(last=False)
+
+
+class WindowedIds:
+    # Ids recorded in buckets by time, a bucket older than the window is dropped as a whole
+    __slots__ = ("_buckets",)
+
+    bucket_size = 86400
+
+    def __init__(self):
+        self._buckets: Dict[int, IntSet] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self._buckets)
+
+    def __contains__(self, value: int) -> bool:
+        return any(value in bucket for bucket in self._buckets.values())
+
+    def __getstate__(self) -> dict:
+        return self._buckets
+
+    def __iter__(self) -> Iterator[int]:
+        for bucket in list(self._buckets.values()):
+            yield from bucket
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self._buckets.values())
+
+    def __repr__(self) -> str:
+        return f"WindowedIds({self._buckets!r})"
+
+    def __setstate__(self, state: dict):
+        self._buckets = state
+
+    def add(self, value: int, now: int):
+        day = now // self.bucket_size
+        bucket = self._buckets.get(day)
+
+        if bucket is None:
+            bucket = self._buckets[day] = IntSet()
+
+        bucket.add(value)
+
+    def count_absent(self, values: Iterable[int]) -> int:
+        # Count the values that are in no bucket, without building a set of them
+        buckets = list(self._buckets.values())
+        return sum(1 for value in values if not any(value in bucket for bucket in buckets))
+
+    def prune(self, before: int) -> bool:
+        # Drop the buckets that end before the time, return True if anything is dropped
+        result = False
+        day = before // self.bucket_size
+
+        # Buckets are added in time order, so the old ones are always at the beginning
+        for bucket_day in list(self._buckets):
+            if bucket_day >= day:
+                break
+
+            self._buckets.pop(bucket_day)
+            result = True
+
+        return result
+
+
+def convert_id_sets(data: Dict[int, Set[int]]) -> bool:
+    # Convert the set values of older versions to IntSet in place, return True if anything changed
+    result = False
+
+    for key in list(data):
+        if isinstance(data[key], IntSet):
+            continue
+
+        data[key] = IntSet(data[key])
+        result = True
+
+    return result
+
+
+def convert_user_ids(user_ids: dict) -> bool:
+    # Convert the dict records of older versions in place, return True if anything changed
+    result = False
+
+    for uid in list(user_ids):
+        if isinstance(user_ids[uid], UserStatus):
+            continue
+
+        user_ids[uid] = UserStatus.from_dict(user_ids[uid])
+        result = True
+
+    return result
+
+
+def convert_windowed_ids(data: Dict[int, Set[int]], now: int) -> bool:
+    # Convert the set values of older versions to WindowedIds in place, the ids are kept for a window from now on
+    result = False
+
+    for key in list(data):
+        if isinstance(data[key], WindowedIds):
+            continue
+
+        ids = WindowedIds()
+
+        for value in data[key]:
+            ids.add(value, now)
+
+        data[key] = ids
+        result = True
+
+    return result
+